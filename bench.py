@@ -0,0 +1,228 @@
+#!/usr/bin/python2
+
+import StringIO
+import threading
+import hashlib
+import zlib
+import re
+import optparse
+import inspect
+import time
+import sys
+import os
+
+# Custom imports
+sys.dont_write_bytecode = True
+from libs import utils
+from libs import config
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-n", "--iterations", dest="iterations", type="int",
+                      help="Iterations per case", action="store",
+                      default=20000)
+    parser.add_option("-o", "--output", dest="output", action="store",
+                      help="Log output file", default=os.devnull)
+    parser.add_option("-c", "--corpus", dest="corpus", action="store",
+                      help="Paths to classify, one per line (ie: find "
+                      "output)", default=None)
+    (options, args) = parser.parse_args()
+    return (options, args)
+
+
+def measure(name, function, iterations):
+    # Print the per-call cost of function
+    started = time.time()
+    for i in xrange(iterations):
+        function(i)
+    elapsed = time.time() - started
+    sys.__stdout__.write("{0:<40} {1:>10.2f} us/call\n".format(
+        name, elapsed * 1000000 / iterations))
+
+
+# Logging: the old wrapper inspected the stack before any level check
+def legacy_log(severity, message, debug):
+    caller = inspect.stack()[1][3]
+    thread = threading.current_thread()
+    utils.log(severity, "B", message, debug, caller, thread)
+
+
+def new_log(severity, message, debug, args=None):
+    if not utils.enabled(severity, debug):
+        return
+    utils.log(severity, "B", message, debug, utils.caller(),
+              threading.current_thread(), args=args)
+
+
+def bench_log(options):
+    action = {'source': "L", 'method': "RSYNC", 'itemtype': "FILE",
+              'filelist': "/srv/share/some/dir/file.txt", 'dstfile': "",
+              'eventid': "abcde", 'backfired': False, 'flags': "normal"}
+    sys.stdout = sys.stderr = open(options.output, "a")
+    measure("suppressed, legacy",
+            lambda i: legacy_log(utils.DEBUG3, "LV2 action: " + str(action),
+                                 0), options.iterations)
+    measure("suppressed, level check + lazy args",
+            lambda i: new_log(utils.DEBUG3, "LV2 action: %s", 0, (action,)),
+            options.iterations)
+    measure("logged, legacy",
+            lambda i: legacy_log(utils.DEBUG1, "Read event: " + str(i), 1),
+            options.iterations)
+    config.log_buffered = False
+    measure("logged, synchronous writes",
+            lambda i: new_log(utils.DEBUG1, "Read event: %d", 1, (i,)),
+            options.iterations)
+    config.log_buffered = True
+    measure("logged, background writer",
+            lambda i: new_log(utils.DEBUG1, "Read event: %d", 1, (i,)),
+            options.iterations)
+    utils.flush_log()
+
+
+# Protocol: what psync.reader does per event, text lines vs frames
+def sample_events(count):
+    return [["RSYNC", "FILE", "/srv/share/some/dir/",
+             "/srv/share/some/dir/file" + str(i) + ".txt",
+             "/srv/share/some/dir/file" + str(i) + ".txt", "normal",
+             "r=1500000000.000,p=1500000000.001,e=1500000005.001"]
+            for i in range(count)]
+
+
+def read_text(stream):
+    for line in stream:
+        line = line.strip(" \n")
+        if re.match("^\[(.*?)\] \[(.*?):(.*?)\] \[(.*?)\]", line):
+            continue
+        if line.find("/srv/share/.psync/heartbeat") >= 0:
+            continue
+        match = re.match("^(RSYNC|MOVE|DELETE|DIRTY|NONE)", line, flags=re.I)
+        if not match or line.count(config.separator) != 7:
+            continue
+        entry = utils.deconcat(line, config.separator)
+        computed = hashlib.md5(line[:-len(config.separator + entry[7])])
+        if computed.hexdigest() != entry[7]:
+            raise ValueError("bad checksum")
+
+
+def read_framed(stream):
+    while True:
+        frame = utils.read_frame(stream)
+        if not frame:
+            break
+        for fields in frame[1]:
+            "{0:05x}".format(zlib.crc32("\0".join(fields)) & 0xfffff)
+
+
+def bench_protocol(options):
+    events = sample_events(options.iterations)
+    text = []
+    for fields in events:
+        line = config.separator.join(fields)
+        text.append(line + config.separator + hashlib.md5(line).hexdigest() +
+                    "\n")
+    text = "".join(text)
+    # The filter sends all the events due at once: assume batches of 100
+    framed = "".join(utils.pack_frame(utils.FRAME_EVENT, events[i:i + 100])
+                     for i in range(0, len(events), 100))
+    sys.__stdout__.write("text:   " + str(len(text) / len(events)) +
+                         " bytes/event\n")
+    sys.__stdout__.write("framed: " + str(len(framed) / len(events)) +
+                         " bytes/event\n")
+    for (name, function, data) in [("text lines", read_text, text),
+                                   ("frames", read_framed, framed)]:
+        started = time.time()
+        function(StringIO.StringIO(data))
+        elapsed = time.time() - started
+        sys.__stdout__.write("{0:<40} {1:>10.2f} us/event\n".format(
+            "read, " + name, elapsed * 1000000 / len(events)))
+
+
+# Integrity: one MD5 per line (text protocol, old helpers) vs one digest
+# per batch of 100 events, for each algorithm
+def bench_hash(options):
+    lines = [config.separator.join(fields) for fields in
+             sample_events(options.iterations)]
+    batches = ["\n".join(lines[i:i + 100]) for i in
+               range(0, len(lines), 100)]
+    started = time.time()
+    for line in lines:
+        hashlib.md5(line).hexdigest()
+    elapsed = time.time() - started
+    sys.__stdout__.write("{0:<40} {1:>10.2f} us/event\n".format(
+        "md5 per line", elapsed * 1000000 / len(lines)))
+    cases = []
+    for algorithm in ["md5", "sha1", "crc32", "hmac-md5", "hmac-sha1",
+                      "hmac-sha256", "blake2b"]:
+        if algorithm == "blake2b" and not utils.blake2b:
+            sys.__stdout__.write("blake2b: not available\n")
+            continue
+        cases.append((algorithm + " per batch", algorithm, batches))
+    for (name, algorithm, data) in cases:
+        started = time.time()
+        for item in data:
+            utils.hexdigest(item, algorithm, "key")
+        elapsed = time.time() - started
+        sys.__stdout__.write("{0:<40} {1:>10.2f} us/event\n".format(
+            name, elapsed * 1000000 / len(lines)))
+
+
+# Classification: filter.parse_line checks, as they were, vs one
+# precompiled classifier
+def legacy_classify(path):
+    if re.search(config.tempfiles, path, re.I):
+        return "tempfile"
+    if (re.search(config.excludes, path.rstrip("/"), re.I) or
+            re.search(config.safesuffix, path.rstrip("/"), re.I)):
+        return "excluded"
+    return None
+
+
+def sample_paths(count):
+    names = ["report.docx", "~$report.docx", "data.tmp", "Thumbs.db",
+             "photo.jpg", "x.psync.ignore", ".budget.xlsx.a1B2c3",
+             "sub/", "notes.txt", "archive.zip"]
+    return ["/srv/share/dept" + str(i % 50) + "/project" + str(i) + "/" +
+            names[i % 10] for i in range(count)]
+
+
+def bench_classify(options):
+    if options.corpus:
+        paths = [line.rstrip("\n") for line in open(options.corpus)]
+    else:
+        paths = sample_paths(options.iterations)
+    classifier = utils.compile_classifier(
+        config.tempfiles, config.excludes + "|" + config.safesuffix)
+    # Same answers, on every path
+    mismatches = [path for path in paths if legacy_classify(path) !=
+                  utils.classify(classifier, path)]
+    sys.__stdout__.write(str(len(paths)) + " paths, " +
+                         str(len(mismatches)) + " mismatches\n")
+    # A file being written fires several events: classify each path
+    # twice, the second time it is cached
+    config.classify_cache = max(config.classify_cache, len(paths))
+    classifier['cache'].clear()
+    for (name, function) in [
+            ("re.search per pattern", legacy_classify),
+            ("classifier, first event",
+             lambda path: utils.classify(classifier, path)),
+            ("classifier, next events",
+             lambda path: utils.classify(classifier, path))]:
+        started = time.time()
+        for path in paths:
+            function(path)
+        elapsed = time.time() - started
+        sys.__stdout__.write("{0:<40} {1:>10.2f} us/path\n".format(
+            name, elapsed * 1000000 / len(paths)))
+
+
+benchmarks = {'log': bench_log, 'protocol': bench_protocol,
+              'hash': bench_hash, 'classify': bench_classify}
+
+(options, args) = parse_options()
+for name in args or sorted(benchmarks):
+    if name not in benchmarks:
+        sys.stderr.write("Unknown benchmark: " + name + "\n")
+        sys.exit(1)
+    sys.__stdout__.write("[" + name + "]\n")
+    benchmarks[name](options)
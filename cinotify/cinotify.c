@@ -23,6 +23,7 @@ bool stats = false;
 
 // Global vars
 int inotify_fd;
+char *root_dir = NULL;
 char *excludes[MAXEXCLUDES] = {NULL};
 char *wd_list[MAXDIRS] = {NULL};
 char moved_from_fullpath[BUFFSIZE] = {0};
@@ -200,6 +201,14 @@ void event_print(struct inotify_event *event, char *event_name, char *dirname, c
 void manage_event(struct inotify_event *event) {
     char *fullpath = NULL;
     char *event_name = NULL;
+    // Queue overflow has no watch: events were lost anywhere in the tree
+    if (event->wd < 0) {
+        if (event->mask & IN_Q_OVERFLOW) {
+            event_print(event, "OVERFLOW", root_dir, root_dir, root_dir, true);
+        }
+        fflush(stdout);
+        return;
+    }
     if (event->len) {
         if (event->mask & IN_ISDIR) {
             asprintf(&fullpath, "%s%s/", wd_list[event->wd], event->name);
@@ -219,7 +228,7 @@ void manage_event(struct inotify_event *event) {
             break;
         case IN_IGNORED:
             event_name = "IGNORED";
-            event_print(event, event_name, wd_list[event->wd], fullpath, fullpath, false);
+            event_print(event, event_name, wd_list[event->wd], fullpath, fullpath, true);
             reset_wd(event->wd);
             break;
         case IN_ACCESS:
@@ -356,6 +365,7 @@ int main(int argc, char **argv) {
         sleep(5);
         return 1;
     }
+    asprintf(&root_dir, "%s/", normalize_dir(dir, true));
     profile_start();
     recursive_watch(dir, true);
     profile_stop("establishing watches");
@@ -4,22 +4,52 @@ import collections
 import subprocess
 import threading
 import optparse
-import inspect
 import hashlib
+import heapq
 import time
 import math
 import sys
 import os
-import re
 
 # Custom imports
 sys.dont_write_bytecode = True
 from libs import utils
 from libs import config
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Dequeues
-raw_queue = collections.deque() #raw events
-actions = collections.deque() #method,itemtype,dir,file,dstfile
+raw_queue = collections.deque() #raw events, read time
+# Actions - heap of (due time, sequence, action), released when due
+actions = []
+conditions = {'raw': threading.Condition(), 'actions': threading.Condition()}
+# Framed protocol - logs waiting to be sent, stdout lock
+logbox = collections.deque()
+output = threading.Lock()
+# Queue bounds - dirs: queued RSYNCs per dir, collapsed: dir -> recursive RSYNC
+# seq: ties in the heap, last: the latest queued action, storms: dirs
+# collapsed, covered: RSYNCs dropped as their dir was collapsed later
+queues = {'dirs': collections.Counter(), 'collapsed': {}, 'degraded': False,
+          'seq': 0, 'last': None, 'storms': 0, 'covered': 0}
+# Settle table - paths: path -> queued RSYNC, restarted by repeated events,
+# barriers: path -> epoch of its last MOVE/DELETE, floor: older epochs
+# are all barred
+settling = {'paths': {}, 'barriers': {}, 'epoch': 0, 'floor': 0,
+            'folded': 0}
+# Path classifier, built from the options
+classifier = {}
+# Metadata cache - stats: path -> (time, stat or None), listings: dir ->
+# (time, {name: scandir entry or None} or None). Entries expire after
+# metadata_ttl, or when an event is read for them. generation: bumped by
+# every event, calls/saved: syscalls done and avoided
+metadata = {'stats': {}, 'listings': {}, 'generation': 0,
+            'calls': collections.Counter(), 'saved': collections.Counter()}
+metalock = threading.Lock()
 
 def parse_options():
     parser = optparse.OptionParser()
@@ -39,6 +69,9 @@ def parse_options():
     parser.add_option("-T", "--translate", dest="translate",
                       help="Translate/replace path element", action="store",
                       default=config.translate)
+    parser.add_option("-P", "--protocol", dest="protocol", action="store",
+                      help="Output protocol (framed, text)",
+                      default=config.filter_protocol)
     parser.add_option("--srcroot", dest="srcroot",
                       action="store", default=None)
     (options, args) = parser.parse_args()
@@ -47,26 +80,31 @@ def parse_options():
     options.psyncdir = utils.normalize_dir(options.srcroot+config.psyncdir)
     return (options, args)
 
-def log(severity, message):
-    caller = inspect.stack()[1][3]
-    thread = threading.current_thread()
-    utils.log(severity, "U", message, options.debug, caller, thread)
-
-def delay_action(action):
-    actions.appendleft(action)
-    sleeptime = time.time() - action['timestamp']
-    time.sleep(options.interval - sleeptime)
+def log(severity, message, args=None):
+    if not utils.enabled(severity, options.debug):
+        return
+    # Framed protocol: stdout only carries frames, so logs which would go
+    # there are sent on the log channel (along with the next frames)
+    if options.protocol == "framed" and severity <= utils.INFO:
+        if args is not None:
+            message = message % args
+        logbox.append([str(severity), utils.caller(), message])
+        return
+    utils.log(severity, "U", message, options.debug, utils.caller(),
+              threading.current_thread(), args=args)
 
 def rsync_file_exists(action):
     # Is the to-be-synched file a valid one?
     try:
-        stat = os.stat(action['file'])
-        return stat
+        stat = cached_stat(action['file'])
+        if stat:
+            return stat
     except:
-        log(utils.DEBUG2,
-            "LV1 event: skipping stale RSYNC event " +
-            "for file: "+action['file'])
-        return None
+        pass
+    log(utils.DEBUG2,
+        "LV1 event: skipping stale RSYNC event " +
+        "for file: "+action['file'])
+    return None
 
 def rsync_early_checks(action):
     if action['method'] != "RSYNC":
@@ -110,21 +148,19 @@ def move_early_checks(action):
         return True
     # Destination
     dst = action['dstfile']
-    # If dst is not a directory, return True
+    # If dst is not a directory (it can not be listed), return True
     # It also returns True when dst does not exists,
     # possibly due to chained MOVEs
-    if not os.path.isdir(dst):
+    names = listing(dst)
+    if names is None:
         return True
     # If dst if empty, return False
     # This is done to discard MOVEs on newly created dirs.
     # In turn, this is done to prevent partial file uploads
     # onto these newly created/renamed directories.
-    try:
-        if not os.listdir(dst):
-            log(utils.DEBUG2, "LV1 event: skipping MOVE on empty dir " + dst)
-            return False
-    except:
-        pass
+    if not names:
+        log(utils.DEBUG2, "LV1 event: skipping MOVE on empty dir " + dst)
+        return False
     # By default, return True (follow the MOVE)
     return True
 
@@ -137,12 +173,18 @@ def rsync_late_checks(action):
         return False
     # Current timestamp
     now = time.time()
-    # Is the file currently being written?
-    if time.time() - stat.st_ctime <= min(1, options.interval):
+    # Is the file currently being written? Then wait for another
+    # interval, unless it is changing since settle_max
+    if (time.time() - stat.st_ctime <= min(1, options.interval) and
+            now - action['first'] < config.settle_max):
         log(utils.INFO,
             "LV1 event: delaying currently changing file " +
             action['file'])
+        redelay(action)
         return False
+    # Its size selects the psync lane
+    if action['itemtype'] == "FILE":
+        action['size'] = stat.st_size
     # If all is ok, return True
     return True
 
@@ -150,7 +192,7 @@ def delete_checks(action):
     # Current timestamp
     now = time.time()
     # Is the file really gone? 1st check
-    if os.path.exists(action['file']):
+    if cached_stat(action['file']):
         log(utils.DEBUG2,
             "LV1 event: skipping DELETE " +
             "for file: " + action['file'] +
@@ -161,11 +203,11 @@ def delete_checks(action):
     token = action['dir']+"."+relname+"."
     log(utils.DEBUG3, "TOKEN: "+token)
     try:
-        for entry in os.listdir(action['dir']):
+        for entry in listing(action['dir']) or []:
             entry = action['dir']+entry
             log(utils.DEBUG3, "ENTRY: "+entry)
             if (token in entry and
-                    now - os.stat(entry).st_ctime <
+                    now - cached_stat(entry).st_ctime <
                     config.delay):
                 log(utils.DEBUG2,
                     "LV1 event: skipping DELETE " +
@@ -176,8 +218,10 @@ def delete_checks(action):
         pass
     # Give a look inside partial dir also
     partialfile = action['dir']+".rsync-partial/"+relname
-    if (os.path.exists(partialfile) and
-            now - os.stat(partialfile).st_ctime < config.delay):
+    partialstat = None
+    if relname in (listing(action['dir']+".rsync-partial/") or []):
+        partialstat = cached_stat(partialfile)
+    if partialstat and now - partialstat.st_ctime < config.delay:
         log(utils.DEBUG2,
             "LV1 event: skipping DELETE " +
             "for file: " + action['file'] +
@@ -192,10 +236,10 @@ def delete_checks(action):
         bckdir = backupdir+reldirname
         log(utils.DEBUG3, "TOKEN: "+bckdir+token)
         try:
-            for entry in os.listdir(bckdir):
+            for (entry, dirent) in (listing(bckdir) or {}).iteritems():
                 log(utils.DEBUG3, "ENTRY: "+bckdir+entry)
                 if (token in entry and
-                        now - os.lstat(bckdir+entry).st_ctime <
+                        now - cached_lstat(bckdir+entry, dirent).st_ctime <
                         config.delay):
                     log(utils.DEBUG2,
                         "LV1 event: skipping DELETE " +
@@ -204,7 +248,7 @@ def delete_checks(action):
                     return False
         except:
             pass
-    # Is the file really gone? 2nd check
+    # Is the file really gone? 2nd check, never cached
     if os.path.exists(action['file']):
         log(utils.DEBUG2,
             "LV1 event: skipping DELETE " +
@@ -214,39 +258,203 @@ def delete_checks(action):
     # If the file is really gone, return True
     return True
 
+def late_checks(action):
+    # Are we sure to delete?
+    if action['method'] == "DELETE":
+        return delete_checks(action)
+    # Late rsync checks. A collapsed dir is synched anyway, as it is
+    # likely always changing
+    if action['method'] == "RSYNC" and action['flags'] != utils.FRECURSE:
+        return rsync_late_checks(action)
+    return True
+
+def cached_stat(path):
+    # os.stat of path, None if missing. Only a stat says a path is missing:
+    # a listing may predate its creation
+    now = time.time()
+    path = path.rstrip("/")
+    with metalock:
+        cached = metadata['stats'].get(path)
+        if cached and now - cached[0] < config.metadata_ttl:
+            metadata['saved']['stat'] = metadata['saved']['stat'] + 1
+            return cached[1]
+        generation = metadata['generation']
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    with metalock:
+        metadata['calls']['stat'] = metadata['calls']['stat'] + 1
+        # Not cached if an event was read meanwhile
+        if metadata['generation'] != generation:
+            return stat
+        if len(metadata['stats']) >= config.metadata_cache:
+            metadata['stats'].clear()
+        metadata['stats'][path] = (now, stat)
+    return stat
+
+def cached_lstat(path, dirent):
+    # os.lstat of a listed path: scandir entries keep theirs
+    if dirent:
+        return dirent.stat(follow_symlinks=False)
+    return os.lstat(path)
+
+def listing(dirname):
+    # Names in dirname -> scandir entries (None without scandir), listed
+    # once per metadata_ttl. None if dirname can not be listed
+    now = time.time()
+    key = dirname.rstrip("/")
+    with metalock:
+        cached = metadata['listings'].get(key)
+        if cached and now - cached[0] < config.metadata_ttl:
+            metadata['saved']['listdir'] = metadata['saved']['listdir'] + 1
+            return cached[1]
+        generation = metadata['generation']
+    try:
+        if scandir:
+            names = dict((dirent.name, dirent) for dirent in scandir(dirname))
+        else:
+            names = dict.fromkeys(os.listdir(dirname))
+    except OSError:
+        names = None
+    with metalock:
+        metadata['calls']['listdir'] = metadata['calls']['listdir'] + 1
+        # Not cached if an event was read meanwhile
+        if metadata['generation'] != generation:
+            return names
+        if len(metadata['listings']) >= config.metadata_cache:
+            metadata['listings'].clear()
+        metadata['listings'][key] = (now, names)
+    return names
+
+def invalidate(paths):
+    # An event was read for paths: forget them and the listings which
+    # include them
+    with metalock:
+        metadata['generation'] = metadata['generation'] + 1
+        for path in paths:
+            path = path.rstrip("/")
+            metadata['stats'].pop(path, None)
+            metadata['listings'].pop(path, None)
+            metadata['listings'].pop(os.path.dirname(path), None)
+
+def emit(action):
+    # Heartbeats are not checked: their file was just touched
+    if action['file'] != heartfile:
+        log(utils.DEBUG3, "LV1 action: %s", (action,))
+        if not late_checks(action):
+            return
+    # Construct fields. Meta carries the read, parse and emit times, for
+    # latency tracing, and the file size
+    meta = ("r=" + "{0:.3f}".format(action['readtime']) + "," +
+            "p=" + "{0:.3f}".format(action['timestamp']) + "," +
+            "e=" + "{0:.3f}".format(time.time()))
+    if 'size' in action:
+        meta = meta + ",s=" + str(action['size'])
+    return [action['method'], action['itemtype'], action['dir'],
+            str(action['file']), str(action['dstfile']), action['flags'],
+            meta]
+
+def send_events(records):
+    if options.protocol == "text":
+        for fields in records:
+            line = config.separator.join(fields)
+            checksum = hashlib.md5(line).hexdigest()
+            print line + config.separator + checksum + "\n",
+        sys.stdout.flush()
+        return
+    # Heartbeats travel on their own channel. Pending logs go first
+    frames = pending_logs()
+    if [fields for fields in records if fields[3] == heartfile]:
+        frames.append(utils.pack_frame(utils.FRAME_HEART, []))
+    records = [fields for fields in records if fields[3] != heartfile]
+    if records:
+        frames.append(utils.pack_frame(utils.FRAME_EVENT, records))
+    write_frames(frames)
+
+def pending_logs():
+    records = []
+    try:
+        while True:
+            records.append(logbox.popleft())
+    except IndexError:
+        pass
+    if not records:
+        return []
+    return [utils.pack_frame(utils.FRAME_LOG, records)]
+
+def write_frames(frames):
+    if not frames:
+        return
+    with output:
+        sys.stdout.write("".join(frames))
+        sys.stdout.flush()
+
+def report():
+    # Queue depths, for psync metrics
+    fields = ["raw_queue=" + str(len(raw_queue)),
+              "actions=" + str(len(actions)),
+              "degraded=" + str(int(bool(queues['degraded']))),
+              "collapsed=" + str(len(queues['collapsed'])),
+              "settled=" + str(settling['folded']),
+              "storms=" + str(queues['storms']),
+              "covered=" + str(queues['covered'])]
+    with metalock:
+        for call in sorted(metadata['calls']):
+            fields.append(call + "_calls=" + str(metadata['calls'][call]))
+            fields.append(call + "_saved=" + str(metadata['saved'][call]))
+    if options.protocol == "text":
+        line = "STATS" + config.separator + config.separator.join(fields)
+        print line + "\n",
+        sys.stdout.flush()
+    else:
+        write_frames(pending_logs() +
+                     [utils.pack_frame(utils.FRAME_STATS, [fields])])
+
 def dequeue():
+    reported = 0
     while True:
-        try:
-            action = actions.popleft()
-            # Current timestamp
+        # Only the consumer prints lines, so that they never interleave
+        if (config.metrics_port and
+                time.time() - reported >= config.metrics_filter_interval):
+            report()
+            reported = time.time()
+        with conditions['actions']:
+            # Drop superseded actions
+            while actions and actions[0][2].get('superseded'):
+                heapq.heappop(actions)
+            # Idle: sleep until an action is queued (or the main thread
+            # ticks)
+            if not actions:
+                conditions['actions'].wait()
+                continue
+            # Sleep until the first one is due. Queuing an action wakes
+            # us up, as it can be due earlier
             now = time.time()
-            # Delay interval time
-            if now - action['timestamp'] >= options.interval:
-                if action['file'] != heartfile:
-                    log(utils.DEBUG3, "LV1 action: "+str(action))
-                # Are we sure to delete?
-                if action['method'] == "DELETE":
-                    if not delete_checks(action):
-                        continue
-                # Late rsync checks
-                if action['method'] == "RSYNC":
-                    if not rsync_late_checks(action):
-                        continue
-                # Construct and print line
-                line = (action['method'] + config.separator +
-                        action['itemtype'] + config.separator +
-                        action['dir'] + config.separator +
-                        str(action['file']) + config.separator +
-                        str(action['dstfile']) + config.separator +
-                        action['flags'])
-                checksum = hashlib.md5(line).hexdigest()
-                print line + config.separator + checksum + "\n",
-                sys.stdout.flush()
-            else:
-                delay_action(action)
-        except:
-            touch(heartfile)
-            time.sleep(1)
+            if actions[0][0] > now:
+                conditions['actions'].wait(actions[0][0] - now)
+                continue
+            # Take all due actions at once
+            due = []
+            while actions and actions[0][0] <= now:
+                action = heapq.heappop(actions)[2]
+                if action.get('superseded'):
+                    continue
+                if covered(action):
+                    queues['covered'] = queues['covered'] + 1
+                    release(action)
+                    continue
+                release(action)
+                due.append(action)
+            check_watermarks()
+            # Wake up the parser, if waiting for room
+            conditions['actions'].notify_all()
+        records = []
+        for action in due:
+            fields = emit(action)
+            if fields:
+                records.append(fields)
+        send_events(records)
 
 def prepare_system():
     create_psyncdir()
@@ -273,7 +481,24 @@ def launch_inotify():
 def read_inotify():
     while True:
         line = inotify.stdout.readline()
-        raw_queue.append(line)
+        with conditions['raw']:
+            # Queue full: stop reading, the kernel queue takes the rest
+            while len(raw_queue) >= config.queue_max:
+                conditions['raw'].wait()
+            raw_queue.append((line, time.time()))
+            conditions['raw'].notify_all()
+
+def parse_raw():
+    while True:
+        # Sleep until lines are read, then parse all of them
+        with conditions['raw']:
+            while not raw_queue:
+                conditions['raw'].wait()
+            lines = list(raw_queue)
+            raw_queue.clear()
+            conditions['raw'].notify_all()
+        for (line, readtime) in lines:
+            parse_line(line, readtime)
 
 def sanitize_path(path):
     if path[:1] == config.separator[-1:] or path[-1:] == config.separator[:1]:
@@ -318,7 +543,7 @@ def translate(line):
         translated = False
     return translated, original, line
 
-def parse_line(line):
+def parse_line(line, readtime):
     line = line.rstrip("\n")
     # Check if it's an inotify logline
     if inotifylog(line):
@@ -346,6 +571,8 @@ def parse_line(line):
         dstfile = utils.normalize_dir(dstfile)
     else:
         itemtype = "FILE"
+    # Whatever the event, cached metadata for its paths is stale
+    invalidate([filename, dstfile])
     event = utils.deconcat(event, ",")[0]
     # Flags - by default, they are empty
     flags = utils.FNORMAL
@@ -374,6 +601,17 @@ def parse_line(line):
         return
     elif event == "MOVE":
         method = "MOVE"
+    # Lost events: let psync check the whole tree on its next timed sync
+    elif event == "OVERFLOW":
+        method = "DIRTY"
+        itemtype = "DIR"
+        dirname = filename = dstfile = options.srcroot
+    # Dropped watch: let psync check the parent dir
+    elif event == "IGNORED":
+        method = "DIRTY"
+        itemtype = "DIR"
+        dirname = utils.normalize_dir(os.path.dirname(filename.rstrip("/")))
+        filename = dstfile = dirname
     # DELETE and undefined method
     elif event == "DELETE":
         method = "DELETE"
@@ -381,25 +619,24 @@ def parse_line(line):
         log(utils.DEBUG2, "Skipping uninteresting event for "+filename)
         return
     # If event if for tempfile, ignore it
-    if re.search(options.tempfiles, dstfile, re.I):
+    dstclass = utils.classify(classifier, dstfile)
+    if dstclass == "tempfile":
         log(utils.DEBUG2, "Skipping event for tempfile "+dstfile)
         return
+    if filename == dstfile:
+        srcclass = dstclass
     else:
-        # If source was a tempfile but destination is a normal file, use RSYNC
-        if re.search(options.tempfiles, filename, re.I):
-            method = "RSYNC"
-            filename = dstfile
-            flags = utils.FFORCE
-            log(utils.DEBUG2, "Changing method from MOVE to RSYNC " +
-                "for tempfile " + filename)
-    # If event is from/to excluded files, ignore it
-    if (re.search(options.excludes, filename.rstrip("/"), re.I) or
-            re.search(options.excludes, dstfile.rstrip("/"), re.I)):
-        log(utils.DEBUG2, "Skipping event for excluded path "+filename)
-        return
-    # Be EXTRA CAREFUL to skip the safesuffix
-    if (re.search(config.safesuffix, filename.rstrip("/"), re.I) or
-            re.search(config.safesuffix, dstfile.rstrip("/"), re.I)):
+        srcclass = utils.classify(classifier, filename)
+    # If source was a tempfile but destination is a normal file, use RSYNC
+    if srcclass == "tempfile":
+        method = "RSYNC"
+        filename = dstfile
+        srcclass = dstclass
+        flags = utils.FFORCE
+        log(utils.DEBUG2, "Changing method from MOVE to RSYNC " +
+            "for tempfile " + filename)
+    # If event is from/to excluded files (or safesuffix), ignore it
+    if srcclass == "excluded" or dstclass == "excluded":
         log(utils.DEBUG2, "Skipping event for excluded path "+filename)
         return
     # If it was a translated line, only allow RSYNC method
@@ -409,7 +646,7 @@ def parse_line(line):
     # Construct action
     entry = {'method':method, 'itemtype':itemtype, 'dir':dirname,
              'file':filename, 'dstfile':dstfile, 'timestamp':time.time(),
-             'flags':flags}
+             'flags':flags, 'readtime':readtime}
     # Rsync checks
     if method == "RSYNC":
         if not rsync_early_checks(entry):
@@ -419,22 +656,208 @@ def parse_line(line):
         if not move_early_checks(entry):
             return
     # Coalesce and append actions
-    try:
-        prev = actions.pop()
-    except:
-        prev = False
-    if prev:
-        if (method == "RSYNC" and prev['method'] == "DELETE" and
+    with conditions['actions']:
+        # Heartbeats are not changes: they are neither settled nor
+        # delayed, and a full queue does not hold them back
+        if filename == heartfile:
+            schedule(entry, entry['timestamp'])
+            conditions['actions'].notify_all()
+            return
+        # Queue full: wait for the consumer to make room
+        while len(actions) >= config.queue_max:
+            conditions['actions'].wait()
+        entry = collapse(entry)
+        if not entry:
+            return
+        settle(entry)
+        # An RSYNC of a just deleted file cancels the DELETE
+        prev = queues['last']
+        if (prev and method == "RSYNC" and prev['method'] == "DELETE" and
                 filename == prev['file']):
-            pass
-        else:
-            actions.append(prev)
-    actions.append(entry)
+            prev['superseded'] = True
+        queues['last'] = entry
+        schedule(entry, entry['timestamp'] + options.interval)
+        check_watermarks()
+        conditions['actions'].notify_all()
+
+def schedule(action, due):
+    # Queue action, to be released at due time. Call with actions
+    # condition held
+    queues['seq'] = queues['seq'] + 1
+    heapq.heappush(actions, (due, queues['seq'], action))
+
+def redelay(action):
+    # Queue again a dequeued RSYNC, due after another interval. Not
+    # needed if a later event for the same file is queued already
+    with conditions['actions']:
+        path = action['file']
+        if path in settling['paths']:
+            return
+        if not barred(path, action['epoch']):
+            settling['paths'][path] = action
+        queues['dirs'][action['dir']] = queues['dirs'][action['dir']] + 1
+        schedule(action, time.time() + options.interval)
+        check_watermarks()
+        conditions['actions'].notify_all()
+
+def check_watermarks():
+    # Enter or leave degraded mode. Call with actions condition held
+    depth = len(actions)
+    if not queues['degraded'] and depth >= config.queue_high_watermark:
+        queues['degraded'] = time.time()
+        log(utils.WARNING, "Actions queue over its high watermark (" +
+            str(depth) + "): collapsing RSYNC events into recursive " +
+            "RSYNCs of their dirs")
+    elif queues['degraded'] and depth <= config.queue_low_watermark:
+        log(utils.WARNING, "Actions queue under its low watermark (" +
+            str(depth) + ") after " +
+            "{0:.1f}".format(time.time() - queues['degraded']) +
+            "s: back to per-file RSYNC events")
+        queues['degraded'] = False
+
+def collapse(entry):
+    # RSYNCs of a storming dir (storm_events queued, ie: read within the
+    # event interval), or of any dir while the queue is degraded, are
+    # folded into a single recursive RSYNC of the dir, which also takes
+    # the RSYNCs of its subdirs. Return the action to queue, if any. Call
+    # with actions condition held
+    dirname = entry['dir']
+    if entry['method'] != "RSYNC":
+        # Later events must not be folded into an earlier RSYNC
+        for path in [dirname, entry['dstfile']]:
+            while covering(path):
+                queues['collapsed'].pop(covering(path)['dir'])
+        return entry
+    pending = covering(dirname)
+    if pending:
+        # The storm goes on: restart the wait of the recursive RSYNC, at
+        # most once a second, for up to settle_max
+        if (entry['timestamp'] - pending['timestamp'] < 1 or
+                entry['timestamp'] - pending['first'] >= config.settle_max):
+            return None
+        entry = dict(pending, timestamp=entry['timestamp'])
+        pending['superseded'] = True
+        queues['collapsed'][entry['dir']] = entry
+        return entry
+    if (not queues['degraded'] and
+            queues['dirs'][dirname] < config.storm_events):
+        queues['dirs'][dirname] = queues['dirs'][dirname] + 1
+        return entry
+    if queues['degraded']:
+        log(utils.DEBUG1, "Queue degraded, collapsing events for " +
+            dirname + " into a recursive RSYNC")
+    else:
+        queues['storms'] = queues['storms'] + 1
+        log(utils.INFO, "Event storm (" +
+            str(queues['dirs'][dirname]) + " queued events) in " + dirname +
+            ", collapsing it into a recursive RSYNC")
+    entry = {'method':"RSYNC", 'itemtype':"DIR", 'dir':dirname,
+             'file':dirname, 'dstfile':dirname,
+             'timestamp':entry['timestamp'], 'flags':utils.FRECURSE,
+             'readtime':entry['readtime'], 'first':entry['timestamp']}
+    queues['collapsed'][dirname] = entry
+    return entry
+
+def covering(path):
+    # The queued recursive RSYNC of path (a dir), or of one of its
+    # parents. Call with actions condition held
+    if not queues['collapsed']:
+        return None
+    path = path.rstrip("/")
+    for key in [path] + utils.ancestors(path):
+        pending = queues['collapsed'].get(utils.normalize_dir(key))
+        if pending:
+            return pending
+    return None
+
+def covered(action):
+    # Was a per-file RSYNC, still queued, taken by a later recursive RSYNC
+    # of its dir? Not if the file was moved or deleted meanwhile. Call
+    # with actions condition held
+    if action['method'] != "RSYNC" or action['flags'] == utils.FRECURSE:
+        return False
+    return bool(covering(action['dir']) and
+                not barred(action['file'], action.get('epoch', 0)))
+
+def barrier(entry):
+    # Repeated RSYNCs must not be folded across a MOVE or DELETE of the
+    # same path, or of a parent dir. Call with actions condition held
+    settling['epoch'] = settling['epoch'] + 1
+    for path in [entry['file'], entry['dstfile']]:
+        settling['barriers'][path.rstrip("/")] = settling['epoch']
+    # Keep the table small: bar everything queued so far
+    if len(settling['barriers']) > config.queue_high_watermark:
+        settling['floor'] = settling['epoch']
+        settling['barriers'].clear()
+
+def barred(path, epoch):
+    # Was path, or one of its parents, moved or deleted after epoch?
+    if epoch < settling['floor']:
+        return True
+    path = path.rstrip("/")
+    for key in [path] + utils.ancestors(path):
+        if settling['barriers'].get(key, 0) > epoch:
+            return True
+    return False
+
+def settle(entry):
+    # A repeated RSYNC restarts the settle timer of the one already
+    # queued for its path: the queued one is superseded (skipped when
+    # dequeued) and entry takes its place. Call with actions condition
+    # held
+    if entry['method'] != "RSYNC":
+        barrier(entry)
+        return
+    if entry['flags'] == utils.FRECURSE:
+        return
+    path = entry['file']
+    pending = settling['paths'].get(path)
+    if (pending and not barred(path, pending['epoch']) and
+            entry['timestamp'] - pending['first'] < config.settle_max):
+        pending['superseded'] = True
+        release(pending)
+        settling['folded'] = settling['folded'] + 1
+        entry['epoch'] = pending['epoch']
+        entry['first'] = pending['first']
+        entry['readtime'] = pending['readtime']
+        if pending['flags'] == utils.FFORCE:
+            entry['flags'] = utils.FFORCE
+    else:
+        entry['epoch'] = settling['epoch']
+        entry['first'] = entry['timestamp']
+    settling['paths'][path] = entry
+
+def release(action):
+    # Action left the queue. Call with actions condition held
+    if action['method'] != "RSYNC":
+        return
+    if settling['paths'].get(action['file']) is action:
+        del settling['paths'][action['file']]
+        if not settling['paths']:
+            settling['barriers'].clear()
+    dirname = action['dir']
+    if action['flags'] == utils.FRECURSE:
+        if queues['collapsed'].get(dirname) is action:
+            queues['collapsed'].pop(dirname)
+        return
+    queues['dirs'][dirname] = queues['dirs'][dirname] - 1
+    if queues['dirs'][dirname] <= 0:
+        del queues['dirs'][dirname]
 
 def touch(filename):
     fd = open(filename, "w")
     fd.close()
 
+def build_classifier():
+    # Excludes, safesuffix (be EXTRA CAREFUL to skip it) and the dirs
+    # cinotify does not watch
+    extra = config.inotify_extra
+    substrings = [extra[i + 1] for i in range(len(extra) - 1)
+                  if extra[i] == "-E"]
+    classifier.update(utils.compile_classifier(
+        options.tempfiles, options.excludes + "|" + config.safesuffix,
+        substrings))
+
 def create_psyncdir():
     if not os.path.exists(options.psyncdir):
         os.makedirs(options.psyncdir)
@@ -444,6 +867,7 @@ def create_psyncdir():
 (options, args) = parse_options()
 heartfile = options.psyncdir+config.heartfile
 backupdir = utils.normalize_dir(options.srcroot+config.backupdir)
+build_classifier()
 # Prepare system
 prepare_system()
 # Launch pipe to inotify
@@ -453,25 +877,29 @@ producer = threading.Thread(name="producer", target=read_inotify)
 producer.daemon = True
 producer.start()
 # Analyze and coalesce changes
+parser = threading.Thread(name="parser", target=parse_raw)
+parser.daemon = True
+parser.start()
 consumer = threading.Thread(name="consumer", target=dequeue)
 consumer.daemon = True
 consumer.start()
 
 # Main thread
+touched = 0
 while True:
-    parse = False
     # Check if inotify is terminated
     if inotify.poll():
         quit(1)
     # Check if psyncdir must be created
     create_psyncdir()
-    # Try reading
-    try:
-        line = raw_queue.popleft()
-        parse = True
-    # If not ready, wait one second
-    except:
-        time.sleep(1)
-    # If I have a line, parse it
-    if parse:
-        parse_line(line)
+    # Beat, whatever is queued: the heartfile event goes through inotify
+    # and the filter, which are checked this way
+    if time.time() - touched >= options.interval:
+        touch(heartfile)
+        touched = time.time()
+    # Let the consumer report, even when idle
+    with conditions['actions']:
+        conditions['actions'].notify_all()
+    # Send logs waiting for a frame
+    write_frames(pending_logs())
+    time.sleep(1)
@@ -41,28 +41,78 @@ tempfiles = "\.tmp$|\.~tmp~|/~\$"
 excludes = (".psync.ignore|" + partialdir + "|" + backupdir +
             "|/\..*\.......$|/____archive____/" +
             "|\.symlink$|/Thumbs.db$")
+classify_cache = 100000 # Paths whose tempfile/exclude match is cached
 
 # Internal configuration
+log_buffered = True # Write logs from a background thread
+log_flush_interval = 0.2 # Seconds between background log writes
+log_buffer_lines = 10000 # Above, logs are written by the logging thread
 psyncdir = normalize_dir(".psync")
 heartfile = "heartbeat"
 separator = ":"
+filter_protocol = "framed" # filter.py to psync.py: "framed" or "text"
+integrity_hash = "md5" # Frames and helper batches digest
+integrity_key = "" # Shared by both partners
 pending_lifetime = 60
 pending_events = ["RSYNC", "DELETE"]
 ssh_options = ["-o", "ConnectTimeout=10", "-C"]
+ssh_mux_dir = "/tmp/psync-ssh/" # Control sockets dir. If empty, no mux
+ssh_mux_channels = 2
 rsync_event_recurse = False
 move_event_recurse = True
 alert_threshold = 10
 rsync_style = 2 # 1: continuous, 2: continuous w/o backfired, 3: batchched
+rsync_batch_window = 10 # Max seconds an event waits in a batch (style 3)
+rsync_batch_size = 5000 # Max files per batch (style 3)
 acl_from_left_only = True
 delay = 60
 maxsize = False # ie: "--max-size=1G". If False no max size is onored
 full_sync_lock = True
+fullsync_incremental = True # Timed full syncs only check touched dirs
+fullsync_full_interval = 168 # Hours between true (whole tree) full syncs
+fullsync_shards = 4 # Concurrent rsync shards per direction. 1: no sharding
+fullsync_shard_balance = "entries" # By "entries", "inodes" or "size"
+fullsync_progress_interval = 60 # Seconds between full sync progress logs
+executor_lanes = {'meta': {'workers': 2, 'bwlimit': 0}, # DELETE, MOVE
+                  'small': {'workers': 2, 'bwlimit': 0},
+                  'large': {'workers': 1, 'bwlimit': 0}, # bwlimit: KB/s
+                  'slow': {'workers': 1, 'bwlimit': 0}} # Retries, no timeout
+executor_small_size = 1048576 # Bytes. Larger files use the "large" lane
+executor_window = 64 # Max queued actions considered for dispatch
+retry_max = 5 # rsync retries of a path, then left to the timed sync
+retry_slow_after = 2 # Failed attempts before moving to the slow lane
+retry_backoff = 10 # Seconds before the first retry, doubled at each one
+retry_backoff_max = 600 # Max seconds between retries
+journal_dir = "/var/lib/psync/" # Action journal dir. If empty, no journal
+journal_sync_interval = 1 # Seconds between journal writes (and fsync)
+journal_compact_lines = 100000 # Compact journal above this many records
+journal_max_replay = 100000 # Above this, do a full sync instead of replay
+journal_max_age = 3600 # Older journals are not trusted
+settle_max = 60 # Max seconds repeated events can delay a file (filter)
+metadata_ttl = 1 # Seconds the filter trusts a cached stat or dir listing
+metadata_cache = 100000 # Max stats (and dir listings) cached by the filter
+queue_max = 500000 # Max queued paths. Above, RSYNC events are dropped
+queue_high_watermark = 200000 # Above, collapse RSYNCs into their dirs
+queue_low_watermark = 100000 # Below, stop collapsing RSYNCs
+queue_dir_collapse = 1000 # Queued paths in a dir before collapsing them (psync)
+storm_events = 100 # Queued events in a dir before collapsing them (filter)
+rsync_stats_file = "/var/log/psync/rsync-stats.log" # If empty, none
+rsync_stats_interval = 10 # Seconds between rsync stats writes
+rsync_stats_max_size = 10485760 # Bytes. Above, rolled over to .1
+bwlimit = 0 # KB/s shared by all rsyncs. 0: no limit
+bwlimit_fullsync = 0 # KB/s shared by full sync rsyncs. 0: no limit
+bwlimit_schedule = [] # (first hour, last hour, class, KB/s) overrides
+metrics_address = "127.0.0.1" # Prometheus metrics address
+metrics_port = 9795 # Prometheus metrics port. If 0, no metrics
+metrics_filter_interval = 5 # Seconds between filter queue reports
+metrics_buckets = [0.01, 0.1, 0.5, 1, 5, 10, 60, 300, 900, 3600] # Seconds
 use_backupdir = False # it often crashes rsync
 
 # Timeouts
 timeout = 60                # General timeout
 itimeout = timeout*5        # Initial inotify timeout
 etimeout = timeout-15       # Execute timeout
+etimeout_grace = 10         # After terminate, seconds before kill
 maxtimeout = timeout*15     # Max connection timeout (abort)
 
 # Schedules
@@ -2,7 +2,6 @@
 
 import optparse
 import os.path
-import hashlib
 import random
 import time
 import sys
@@ -34,7 +33,12 @@ def parse_options():
                       default=config.force)
     parser.add_option("-c", "--checksum", dest="checksum", action="store",
                       help="Action checksum", default=None)
+    parser.add_option("-s", "--stdin", dest="stdin", action="store_true",
+                      help="Read paths from stdin, one per line",
+                      default=False)
     (options, args) = parser.parse_args()
+    if options.stdin:
+        args = args + [arg for arg in utils.deconcat(sys.stdin.read()) if arg]
     return (options, args)
 
 def delete_file(filename):
@@ -166,10 +170,8 @@ def move(args):
     return exitcode
 
 def verify_checksum():
-    computed = options.action
-    for arg in args:
-        computed = utils.concat(computed, arg)
-    computed = hashlib.md5(computed).hexdigest()
+    # A single digest covers the whole batch of paths
+    computed = utils.hexdigest(utils.concat(options.action, "\n".join(args)))
     if options.checksum == computed:
         if options.debug > 1:
             print ("Valid helper action checksum. Received: " +
@@ -1,14 +1,24 @@
 #!/usr/bin/python2
 
+import collections
 import subprocess
 import threading
-import inspect
+import hashlib
+import atexit
+import struct
+import hmac
 import time
+import re
+import zlib
 import sys
 
 # Custom imports
 sys.dont_write_bytecode = True
 import config
+try:
+    from pyblake2 import blake2b
+except ImportError:
+    blake2b = getattr(hashlib, "blake2b", None)
 
 #### SEVERITY DEFINES #####
 FATAL = 4
@@ -24,24 +34,128 @@ DEBUG3 = -3
 #### FILTER FLAGS ####
 FNORMAL = "normal"
 FFORCE = "force"
+FRECURSE = "recurse"
 ######################
 
+#### FRAME CHANNELS ####
+FRAME_EVENT = 1
+FRAME_LOG = 2
+FRAME_HEART = 3
+FRAME_STATS = 4
+#########################
+
 ### EXIT CODES ###
 PSUCCESS = 0
 PERROR = 1
 PSOFTERROR = 100
 RSYNC_SUCCESS = [0, 23, 24]
 RSYNC_TERMINATED = 20
+# Killed, or lost (socket, stream, timeout, ssh) connection
+RSYNC_RETRY = [RSYNC_TERMINATED, 10, 12, 30, 35, 255]
 ##################
 
+# Log writer - lines: (to stderr, text) waiting for the background writer
+logwriter = {'lines': collections.deque(), 'output': threading.Lock(),
+             'start': threading.Lock(), 'thread': None}
+# Frames: magic, version, channel, payload length, digest length. The
+# payload is a list of records, each a length-prefixed, NUL-separated
+# list of fields, and is followed by the digest of header and payload
+frame_magic = "PSF"
+frame_version = 2
+frame_header = struct.Struct("!3sBBIB")
+frame_record = struct.Struct("!I")
+
+# rsync -i lines: update type, file type and attributes, then the path
+itemize_line = re.compile("^([<>ch.])([fdLDS])([.+ ?a-z]{8,9}) ")
+
+# Digest length by algorithm
+digest_sizes = {}
+
+# Current second and its formatted timestamp
+clock = {'now': (0, "")}
+
 def inv(number):
     return number*-1
 
+def enabled(severity, debug):
+    # Would a message be logged? Remote (string) severities always are
+    if type(severity) is str:
+        return True
+    return severity >= inv(debug)
+
+def caller(depth=2):
+    # Name of the function depth frames up: by default, the caller of
+    # the function calling caller()
+    return sys._getframe(depth).f_code.co_name
+
+def timestamp():
+    # strftime only once per second
+    now = int(time.time())
+    (second, text) = clock['now']
+    if second != now:
+        text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        clock['now'] = (now, text)
+    return text
+
+def write_log(lines):
+    # Write (to stderr, text) lines, one write per stream switch
+    with logwriter['output']:
+        i = 0
+        while i < len(lines):
+            stderr = lines[i][0]
+            chunk = []
+            while i < len(lines) and lines[i][0] == stderr:
+                chunk.append(lines[i][1])
+                i = i + 1
+            stream = sys.stderr if stderr else sys.stdout
+            stream.write("".join(chunk))
+            stream.flush()
+
+def flush_log():
+    # Write whatever is waiting for the background writer
+    lines = []
+    try:
+        while True:
+            lines.append(logwriter['lines'].popleft())
+    except IndexError:
+        pass
+    if lines:
+        write_log(lines)
+
+def log_writer():
+    while True:
+        time.sleep(config.log_flush_interval)
+        flush_log()
+
+def queue_log(lines, sync=False):
+    # Hand lines to the background writer. Without it, or for
+    # critical lines, write them now, after the already queued ones
+    if sync or not config.log_buffered:
+        flush_log()
+        write_log(lines)
+        return
+    if not logwriter['thread']:
+        with logwriter['start']:
+            if not logwriter['thread']:
+                thread = threading.Thread(name="logwriter", target=log_writer)
+                thread.daemon = True
+                thread.start()
+                atexit.register(flush_log)
+                logwriter['thread'] = thread
+    # Appending to a deque is thread safe: no lock on the hot path
+    logwriter['lines'].extend(lines)
+    # If the writer can not keep up, write from here
+    if len(logwriter['lines']) > config.log_buffer_lines:
+        flush_log()
+
 def log(severity, source, message, debug=config.debug,
-        caller=False, thread=False, raw=0, eventid=None):
+        caller=False, thread=False, raw=0, eventid=None, args=None):
     debug = inv(debug)
     if severity < debug:
         return
+    # Lazy formatting: only done for logged messages
+    if args is not None:
+        message = message % args
     if len(message) == 0:
         return
     # If string, convert to int
@@ -67,14 +181,14 @@ def log(severity, source, message, debug=config.debug,
         sevname = "UND"
     # Get caller, thread and eventid
     if not caller:
-        caller = inspect.stack()[1][3]
+        caller = sys._getframe(1).f_code.co_name
     if not thread:
         thread = threading.current_thread()
     if not eventid:
         eventid = "undef"
     # Print
     message = deconcat(message)
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    now = timestamp()
     eventid = eventid+"      "
     eventid = eventid[:5]
     caller = caller+"        "
@@ -85,34 +199,36 @@ def log(severity, source, message, debug=config.debug,
     thread = thread.name
     thread = thread+"        "
     thread = thread[:9]
+    lines = []
     for line in message:
         # Generate log line
         if raw > 0:
-            logline = ("["+timestamp+"] ["+sevname+":"+
+            logline = ("["+now+"] ["+sevname+":"+
                        "{0:+d}".format(severity)+"] ["+source+"] "+ line)
         elif debug > DEBUG3:
-            logline = ("["+timestamp+"] ["+sevname+":"+
+            logline = ("["+now+"] ["+sevname+":"+
                        "{0:+d}".format(severity)+"] ["+source+"] ["+
                        eventid+"] ["+caller+"] " + line)
         else:
-            logline = ("["+timestamp+"] ["+sevname+":"+
+            logline = ("["+now+"] ["+sevname+":"+
                        "{0:+d}".format(severity)+"] ["+source+"] ["+
                        eventid+"] ["+caller+"] ["+thread+"] ["+ident+"] " +
                        line)
         # Select stdout or stderr
-        if severity > INFO:
-            sys.stderr.write(logline+"\n")
-        else:
-            print logline+"\n",
-            sys.stdout.flush()
+        lines.append((severity > INFO, logline+"\n"))
+    queue_log(lines, severity >= CRITICAL)
 
 def execute(cmd, source, stdin, warn=True, timeout=False, heartbeats=False,
-            dryrun=False, debug=config.debug, eventid=None):
+            dryrun=False, debug=config.debug, eventid=None, reaper=None,
+            command=None):
     # It is rsync?
     if cmd[0].find("rsync") >= 0:
         commandtype = "rsync"
     else:
         commandtype = "other"
+    # Command type, as reported to the reaper. By default, the executable
+    if not command:
+        command = cmd[0].split("/")[-1]
     # Dry run?
     if dryrun:
         prefix = "*** DRY RUN ***"
@@ -128,20 +244,26 @@ def execute(cmd, source, stdin, warn=True, timeout=False, heartbeats=False,
         source, prefix+"COMMAND LINE for PID "+str(process.pid)+": "+str(cmd),
         debug=debug, eventid=eventid)
     entry = {'last':time.time(), 'timeout':timeout, 'process':process,
-             'pid':process.pid}
+             'pid':process.pid, 'command':command}
     if heartbeats:
         heartbeats['execute'][process.pid] = entry
+    # Let the reaper enforce the timeout
+    if reaper:
+        reaper(entry)
     (output, error) = process.communicate(stdin)
     # Unregister process
     if heartbeats:
         heartbeats['execute'].pop(process.pid, None)
-    # Log and return
-    if output:
+    # Log and return. Stats are only logged at high debug levels
+    logged = output
+    if logged and commandtype == "rsync" and inv(debug) > DEBUG2:
+        logged = strip_rsync_stats(logged)
+    if logged:
         if debug:
-            output = (prefix +
+            logged = (prefix +
                       "COMMAND OUTPUT for PID "+str(process.pid)+": \n"+
-                      output)
-        log(INFO, source, output, debug=debug, eventid=eventid)
+                      logged)
+        log(INFO, source, logged, debug=debug, eventid=eventid)
     log(DEBUG1, source,
         prefix+"FINISHED COMMAND with PID "+str(process.pid)+", EXIT CODE "+
         str(process.returncode), debug=debug, eventid=eventid)
@@ -159,6 +281,145 @@ def execute(cmd, source, stdin, warn=True, timeout=False, heartbeats=False,
                 log(INFO, source, error, debug=debug, eventid=eventid)
     return (process, output, error)
 
+def rsync_stat(line):
+    # "Literal data: 1,234 bytes" -> 1234
+    return int(line.split(":")[1].split()[0].replace(",", ""))
+
+def parse_rsync_stats(output):
+    # Pick transfer counters from rsync --stats output, and count the
+    # -i itemized changes: new entries, updated files, attributes only
+    # changes and deletions
+    stats = {'files': 0, 'bytes': 0, 'sent': 0, 'received': 0, 'size': 0,
+             'literal': 0, 'matched': 0, 'new': 0, 'updated': 0, 'attrs': 0,
+             'deleted': 0}
+    for line in deconcat(output or ""):
+        match = itemize_line.match(line)
+        if match:
+            if not match.group(3).strip("+"):
+                stats['new'] = stats['new'] + 1
+            elif match.group(1) in "<>":
+                stats['updated'] = stats['updated'] + 1
+            else:
+                stats['attrs'] = stats['attrs'] + 1
+        elif line.startswith("*deleting "):
+            stats['deleted'] = stats['deleted'] + 1
+        elif (line.startswith("Number of regular files transferred:") or
+                line.startswith("Number of files transferred:")):
+            stats['files'] = rsync_stat(line)
+        elif line.startswith("Total file size:"):
+            stats['size'] = rsync_stat(line)
+        elif line.startswith("Total transferred file size:"):
+            stats['bytes'] = rsync_stat(line)
+        elif line.startswith("Literal data:"):
+            stats['literal'] = rsync_stat(line)
+        elif line.startswith("Matched data:"):
+            stats['matched'] = rsync_stat(line)
+        elif line.startswith("Total bytes sent:"):
+            stats['sent'] = rsync_stat(line)
+        elif line.startswith("Total bytes received:"):
+            stats['received'] = rsync_stat(line)
+    return stats
+
+def strip_rsync_stats(output):
+    # Drop the rsync --stats block, which starts with "Number of files:"
+    index = output.find("Number of files:")
+    if index < 0:
+        return output
+    return output[:index].rstrip("\n")
+
+def compile_classifier(tempfiles, excludes, substrings=[]):
+    # All tempfile and exclude patterns, compiled once. Substrings (as
+    # cinotify -E ones) exclude paths inside dirs whose name contains them
+    excludes = "|".join(["(?:" + excludes + ")"] +
+                        [re.escape(substring) + "[^/]*/"
+                         for substring in substrings])
+    return {'tempfile': re.compile(tempfiles, re.I),
+            'excluded': re.compile(excludes, re.I), 'cache': {}}
+
+def classify(classifier, path):
+    # "tempfile", "excluded" or None. A tempfile is never "excluded", and
+    # exclude patterns do not see the trailing slash of dirs. Paths recur
+    # (a file being written fires several events): answers are cached
+    cache = classifier['cache']
+    kind = cache.get(path, False)
+    if kind is not False:
+        return kind
+    if classifier['tempfile'].search(path):
+        kind = "tempfile"
+    elif classifier['excluded'].search(path.rstrip("/")):
+        kind = "excluded"
+    else:
+        kind = None
+    if len(cache) >= config.classify_cache:
+        cache.clear()
+    cache[path] = kind
+    return kind
+
+def digest(data, algorithm=None, key=None):
+    # Raw digest of data. hmac-* and blake2b are keyed
+    if not algorithm:
+        algorithm = config.integrity_hash
+    if key is None:
+        key = config.integrity_key
+    if algorithm == "crc32":
+        return struct.pack("!I", zlib.crc32(data) & 0xffffffff)
+    if algorithm.startswith("hmac-"):
+        return hmac.new(key, data, getattr(hashlib, algorithm[5:])).digest()
+    if algorithm == "blake2b":
+        if not blake2b:
+            raise ValueError("blake2b needs python >= 3.6 or pyblake2")
+        return blake2b(data, key=key[:64], digest_size=20).digest()
+    return hashlib.new(algorithm, data).digest()
+
+def hexdigest(data, algorithm=None, key=None):
+    return digest(data, algorithm, key).encode("hex")
+
+def pack_frame(channel, records):
+    payload = []
+    for fields in records:
+        record = "\0".join(fields)
+        payload.append(frame_record.pack(len(record)))
+        payload.append(record)
+    payload = "".join(payload)
+    algorithm = config.integrity_hash
+    if algorithm not in digest_sizes:
+        digest_sizes[algorithm] = len(digest("", algorithm))
+    header = frame_header.pack(frame_magic, frame_version, channel,
+                               len(payload), digest_sizes[algorithm])
+    return header + payload + digest(header + payload, algorithm)
+
+def read_frame(stream):
+    # Return (channel, records), or None at end of stream. Raise
+    # ValueError on a malformed frame: the stream can not be trusted
+    header = stream.read(frame_header.size)
+    if not header:
+        return None
+    if len(header) < frame_header.size:
+        raise ValueError("truncated header")
+    (magic, version, channel, length, size) = frame_header.unpack(header)
+    if magic != frame_magic:
+        raise ValueError("bad magic " + repr(magic))
+    if version != frame_version:
+        raise ValueError("unsupported version " + str(version))
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise ValueError("truncated payload")
+    received = stream.read(size)
+    if len(received) < size:
+        raise ValueError("truncated digest")
+    if not hmac.compare_digest(received, digest(header + payload)):
+        raise ValueError("bad digest")
+    records = []
+    offset = 0
+    while offset < length:
+        if offset + frame_record.size > length:
+            raise ValueError("truncated record")
+        (size,) = frame_record.unpack_from(payload, offset)
+        offset = offset + frame_record.size
+        records.append(payload[offset:offset + size].split("\0"))
+        offset = offset + size
+    return (channel, records)
+
 def gen_exclude(excludes):
     excludelist = []
     if type(excludes) is list:
@@ -186,3 +447,15 @@ def deconcat(original, separator='\n', strip=True):
 
 def is_parent_of(parent, child):
     return child.startswith(normalize_dir(parent))
+
+def ancestors(path):
+    # "/a/b/c" -> ["/", "/a", "/a/b"]
+    parents = []
+    index = path.rfind("/")
+    while index > 0:
+        path = path[:index]
+        parents.append(path)
+        index = path.rfind("/")
+    if index == 0 and len(path) > 1:
+        parents.append("/")
+    return parents
@@ -2,11 +2,19 @@
 
 import collections
 import subprocess
+import Queue
 import threading
 import optparse
-import inspect
+import fnmatch
+import atexit
 import hashlib
+import heapq
+import bisect
+import random
+import socket
+import zlib
 import os.path
+import pipes
 import time
 import sys
 import os
@@ -20,17 +28,97 @@ from libs import config
 # Globally writable objects
 # Deque, dictionary and the likes
 actions = collections.deque()   # Actions - source,method,itemtype,files,dstfile
-locks = {'global':threading.Lock()} # Locks
+locks = {'global':threading.Lock(), # Locks
+         'pendings':threading.Lock(),
+         'batches':threading.Lock(),
+         'flush':threading.Lock(),
+         'actions':threading.Lock(),
+         'journal':threading.Lock(),
+         'metrics':threading.Lock(),
+         'retries':threading.Lock(),
+         'sshpool':threading.Lock(),
+         'dirs':threading.Lock()}
 dirs = {'L': {}, 'R': {}}           # Touched directories
-pendings = {'L': {}, 'R': {}}       # L,R
+pendings = {'L': {}, 'R': {}}       # L,R - entry: insertion time
+batches = {'L': {}, 'R': {}}        # L,R - flags,lane: files,first,eventid
+expiries = {'L': [], 'R': []}       # L,R - heap of (expiry time, entry)
 
 # Current state
 state = {
     'current_merges': 0,
+    'pendings_hits': 0,
+    'pendings_misses': 0,
+    'pendings_expired': 0,
+    'ssh_handshakes': 0,
+    'ssh_handshakes_avoided': 0,
+    'ssh_reconnects': 0,
+    'coalesced_duplicates': 0,
+    'coalesced_cancels': 0,
+    'coalesced_moves': 0,
+    'fullsync_last': 0,
+    'fullsync_catchup': False,
+    'queue_degraded': False,
+    'queue_degraded_since': 0,
+    'queue_degradations': 0,
+    'queue_collapsed': 0,
+    'queue_dropped': 0,
+    'retries': 0,
+    'retry_escalations': 0,
+    'retry_giveups': 0,
 }
 
+# Text protocol lines: remote log lines and events
+logline = re.compile("^\[(.*?)\] \[(.*?):(.*?)\] \[(.*?)\]")
+eventline = re.compile("^(RSYNC|MOVE|DELETE|DIRTY|NONE)", re.I)
+
+# Coalescing index over queued actions
+# paths: root-relative path -> queued actions touching it, oldest first
+# tails: (source,method,flags,backfired) -> latest mergeable action
+# dirs: (source,dir) -> queued paths inside dir
+# collapsed: (source,dir) -> queued recursive RSYNC covering dir
+queued = {'seq': 0, 'paths': {}, 'tails': {},
+          'dirs': collections.Counter(), 'collapsed': {}}
+
+# Executor - running actions (by lane) and the paths they hold
+executor = {'running': collections.Counter(), 'workers': [],
+            'queues': dict((lane, Queue.Queue())
+                           for lane in config.executor_lanes),
+            'busy': collections.Counter(), 'parents': collections.Counter()}
+conditions = {'executor': threading.Condition(),
+              'deadlines': threading.Condition(),
+              'bandwidth': threading.Condition()}
+
+# Command deadlines - heap of (deadline, pid, signal, heartbeat entry)
+deadlines = {'heap': []}
+
+# Action journal - accepted events not yet completed
+# live: journal id -> record, buffer: records not yet written
+journal = {'id': 0, 'live': {}, 'buffer': [], 'lines': 0, 'replay': [],
+           'fd': None}
+
+# Metrics - exits: (source,command,exit code) -> count,
+# rsync: transfer counters, filters: last queue report of each filter,
+# latency: (stage,method) -> histogram, kills: (command,signal) -> count
+metrics = {'exits': collections.Counter(),
+           'rsync': {'L': collections.Counter(), 'R': collections.Counter()},
+           'filters': {'L': {}, 'R': {}}, 'latency': {},
+           'kills': collections.Counter()}
+
+# Failed rsyncs - heap of (due time, id, action), (source,file): attempts
+retries = {'heap': [], 'attempts': {}, 'next': 0}
+
+# rsync stats records waiting to be written
+rsyncstats = {'buffer': collections.deque()}
+
+# Bandwidth leases - id: (class, KB/s) of each running rsync
+bandwidth = {'leases': {}, 'next': 0}
+
+# SSH control connections - path,process
+sshpool = {'channels': [], 'next': 0}
+
 schedules = {
-    'fullsync': {'hours': config.fullsync}
+    'fullsync': {'hours': config.fullsync},
+    'bandwidth': {'hours': config.bwlimit_schedule}
 }
 
 # Heartbeats
@@ -48,18 +136,35 @@ heartbeats = {
 }
 
 # Wrapper functions
-def log(severity, source, message, raw=0, eventid=None):
-    caller = inspect.stack()[1][3]
-    thread = threading.current_thread()
-    utils.log(severity, source, message, options.debug, caller, thread, raw,
-              eventid)
+def log(severity, source, message, raw=0, eventid=None, args=None):
+    if not utils.enabled(severity, options.debug):
+        return
+    utils.log(severity, source, message, options.debug, utils.caller(),
+              threading.current_thread(), raw, eventid, args)
 
 
 def execute(cmd, source, stdin, warn=True,
-            timeout=heartbeats['execute']['default']['timeout'], eventid=None):
-    return utils.execute(cmd, source, stdin, warn=warn, timeout=timeout,
-                         heartbeats=heartbeats, dryrun=options.dryrun,
-                         debug=options.debug, eventid=eventid)
+            timeout=heartbeats['execute']['default']['timeout'], eventid=None,
+            command="helper", launched=None):
+    # command: rsync, DELETE, MOVE or helper. Remote helpers run through
+    # ssh, so it is not told by the executable. launched: called with the
+    # heartbeat entry of the running command
+    def reaper(entry):
+        schedule_deadline(entry)
+        if launched:
+            launched(entry)
+    started = time.time()
+    (process, output, error) = utils.execute(cmd, source, stdin, warn=warn,
+                                             timeout=timeout,
+                                             heartbeats=heartbeats,
+                                             dryrun=options.dryrun,
+                                             debug=options.debug,
+                                             eventid=eventid,
+                                             reaper=reaper,
+                                             command=command)
+    account(command, source, process, output, time.time() - started,
+            eventid)
+    return (process, output, error)
 
 # Private functions
 def parse_options():
@@ -103,11 +208,10 @@ def parse_options():
     parser.add_option("--dstroot", dest="dstroot", action="store",
                       default=None)
     (options, args) = parser.parse_args()
-    # Let rsync be more verbose based of debug level
+    # Let rsync be more verbose based of debug level. --stats is always
+    # passed, for the transfer metrics
     if options.debug:
         options.rsync_extra.append("-v")
-    if options.debug > 1:
-        options.rsync_extra.append("--stats")
     # If dryrun, increase debug level
     if options.dryrun:
         options.debug = 2
@@ -138,51 +242,171 @@ def check_delete(filelist, source):
     return (protected, todelete)
 
 
-def dequeue():
+def relpath(source, path):
+    # Root-relative path, without trailing slash
+    if source == "L":
+        root = options.srcroot
+    else:
+        root = options.dstroot
+    return "/" + path[len(root):].strip("/")
+
+
+def action_paths(action):
+    # Root-relative paths touched by an action, used for ordering
+    paths = utils.deconcat(action['filelist'])
+    if action['method'] == "MOVE":
+        paths.append(action['dstfile'])
+    return [relpath(action['source'], path) for path in paths]
+
+
+def claim_paths(paths, busy, parents, count=1):
+    for path in paths:
+        busy[path] = busy[path] + count
+        for parent in utils.ancestors(path):
+            parents[parent] = parents[parent] + count
+    # Drop released entries to keep lookups small
+    if count < 0:
+        for counter in (busy, parents):
+            for path in [key for key in counter if counter[key] <= 0]:
+                del counter[path]
+
+
+def conflicting_paths(paths, busy, parents):
+    # Same path, ancestor or descendant of an already claimed path
+    for path in paths:
+        if busy[path] or parents[path]:
+            return True
+        for parent in utils.ancestors(path):
+            if busy[parent]:
+                return True
+    return False
+
+
+def execute_action(action):
+    log(utils.DEBUG1, action['source'],
+        "Dequeue, using method " + action['method'],
+        eventid=action['eventid'])
+    log(utils.DEBUG3, action['source'], "LV2 action: %s", args=(action,),
+        eventid=action['eventid'])
+    if are_ready():
+        # Select appropriate command
+        if action['method'] == "RSYNC":
+            rsync(action, acl=True)
+        if action['method'] == "DELETE":
+            # If full sync is running and locks are enabled,
+            # skip DELETE events
+            if config.full_sync_lock:
+                if locks['global'].acquire(False):
+                    locks['global'].release()
+                    delete(action)
+                elif not full_syncher.is_alive():
+                    delete(action)
+                else:
+                    for filename in utils.deconcat(action['filelist']):
+                        log(utils.INFO, action['source'],
+                            "FULL SYNC in progress. Skipping DELETE for " +
+                            filename, eventid=action['eventid'])
+            else:
+                delete(action)
+        if action['method'] == "MOVE":
+            move(action)
+    else:
+        for filename in utils.deconcat(action['filelist']):
+            log(utils.ERROR, action['source'],
+                "Not connected, removing from queue event " +
+                action['method'] + config.separator + filename,
+                eventid=action['eventid'])
+
+
+def lane_of(action):
+    # DELETE and MOVE, small files and big transfers do not wait for
+    # each other
+    if action['method'] != "RSYNC":
+        return "meta"
+    if (action['recurse'] or
+            action.get('size', 0) > config.executor_small_size):
+        return "large"
+    return "small"
+
+
+def worker(lane):
     while True:
-        beat("dequeue")
+        (action, paths) = executor['queues'][lane].get()
+        seq = action['seq']
+        method = action['method']
+        started = time.time()
         try:
-            action = actions.popleft()
-        except:
-            time.sleep(1)
-            continue
+            execute_action(action)
+            # Completed, unless rescheduled
+            if action['seq'] == seq:
+                journal_done(action.get('journal'))
+                trace_action(action, method, started)
+        finally:
+            # Release paths and wake up the dispatcher
+            with conditions['executor']:
+                claim_paths(paths, executor['busy'], executor['parents'],
+                            -1)
+                executor['running'][lane] = executor['running'][lane] - 1
+                conditions['executor'].notify()
+
+
+def dequeue():
+    # Start workers
+    for lane in sorted(config.executor_lanes):
+        for i in range(config.executor_lanes[lane]['workers']):
+            thread = threading.Thread(name=lane + str(i), target=worker,
+                                      args=(lane,))
+            thread.daemon = True
+            thread.start()
+            executor['workers'].append(thread)
+    # Actions waiting to be dispatched, in queue order
+    waiting = collections.deque()
+    while True:
+        # A crashed worker is a crashed dequeue: stop beating
+        if all(thread.is_alive() for thread in executor['workers']):
+            beat("dequeue")
+        # Flush expired rsync batches and queue due retries
+        if config.rsync_style == 3:
+            flush_batches("L")
+            flush_batches("R")
+        release_retries()
+        while len(waiting) < config.executor_window:
+            action = unqueue()
+            if not action:
+                break
+            waiting.append((action, action_paths(action)))
         # Print queue length
-        log(utils.DEBUG1, "B", "Actions queue length: "+
-            str(len(actions)+1), eventid=action['eventid'])
-        # Refresh pendings
-        log(utils.DEBUG1, action['source'],
-            "Dequeue, using method " + action['method'],
-            eventid=action['eventid'])
-        log(utils.DEBUG3, action['source'], "LV2 action: " + str(action),
-            eventid=action['eventid'])
-        if are_ready():
-            # Select appropriate command
-            if action['method'] == "RSYNC":
-                rsync(action, acl=True)
-            if action['method'] == "DELETE":
-                # If full sync is running and locks are enabled,
-                # skip DELETE events
-                if config.full_sync_lock:
-                    if locks['global'].acquire(False):
-                        locks['global'].release()
-                        delete(action)
-                    elif not full_syncher.is_alive():
-                        delete(action)
-                    else:
-                        for filename in utils.deconcat(action['filelist']):
-                            log(utils.INFO, action['source'],
-                                "FULL SYNC in progress. Skipping DELETE for " +
-                                filename, eventid=action['eventid'])
+        if waiting:
+            log(utils.DEBUG1, "B", "Actions queue length: " +
+                str(len(actions) + len(waiting)))
+        # Dispatch in queue order any action whose lane has a free worker
+        # and which does not touch the same paths of a running or of a
+        # previous, still waiting, action
+        blocked = {'busy': collections.Counter(),
+                   'parents': collections.Counter()}
+        # Lock order: the batches and retries locks are never taken
+        # under the executor condition
+        timeout = next_flush()
+        with conditions['executor']:
+            for i in range(len(waiting)):
+                (action, paths) = waiting.popleft()
+                lane = action['lane']
+                if (executor['running'][lane] <
+                        config.executor_lanes[lane]['workers'] and
+                        not conflicting_paths(paths, executor['busy'],
+                                              executor['parents']) and
+                        not conflicting_paths(paths, blocked['busy'],
+                                              blocked['parents'])):
+                    claim_paths(paths, executor['busy'], executor['parents'])
+                    executor['running'][lane] = executor['running'][lane] + 1
+                    executor['queues'][lane].put((action, paths))
                 else:
-                    delete(action)
-            if action['method'] == "MOVE":
-                move(action)
-        else:
-            for filename in utils.deconcat(action['filelist']):
-                log(utils.ERROR, action['source'],
-                    "Not connected, removing from queue event " +
-                    action['method'] + config.separator + filename,
-                    eventid=action['eventid'])
+                    claim_paths(paths, blocked['busy'], blocked['parents'])
+                    waiting.append((action, paths))
+            # Sleep until an action is queued, a worker completes, a batch
+            # expires or the main loop ticks
+            if not actions or len(waiting) >= config.executor_window:
+                conditions['executor'].wait(timeout)
 
 
 def get_mirror(source):
@@ -193,6 +417,20 @@ def get_mirror(source):
     return mirror
 
 
+def expire_pendings(side, now):
+    # Pop expired entries from the heap. An entry re-inserted after being
+    # scheduled for expiry has a newer timestamp: skip its old heap slot
+    heap = expiries[side]
+    while heap and heap[0][0] < now:
+        (expiry, entry) = heapq.heappop(heap)
+        timestamp = pendings[side].get(entry)
+        if timestamp is None or timestamp + config.pending_lifetime > expiry:
+            continue
+        log(utils.DEBUG2, side, "Clearing stale entry " + entry)
+        pendings[side].pop(entry, None)
+        state['pendings_expired'] = state['pendings_expired'] + 1
+
+
 def check_pendings(source, filename, method, eventid=None):
     log(utils.DEBUG1, source, "Active pendings check", eventid=eventid)
     mirror = get_mirror(source)
@@ -204,40 +442,28 @@ def check_pendings(source, filename, method, eventid=None):
     relname = filename[offset:]
     entry = method + config.separator + relname
     log(utils.DEBUG2, source, "Requesting: " + entry, eventid=eventid)
-    # Check if a valid pending entry exists
-    found = False
     now = time.time()
-    for pending in pendings[mirror].keys():
-        # If found...
-        if pending == entry:
-            # ...and if valid, ignore event
-            if now-pendings[mirror][entry] <= config.pending_lifetime:
-                found = True
-                log(utils.DEBUG1, source,
-                    "File found. Backfired inotify event " + entry,
-                    eventid=eventid)
-                if method == "MOVE":
-                    log(utils.DEBUG2, source, "Removing: " + entry,
-                        eventid=eventid)
-                    pendings[mirror].pop(entry, None)
-            else:
-                # ... and if not valid, remove it from pending list
-                log(utils.DEBUG2, source,
-                    "Stale entry. Pretend nothing matched for " + entry,
+    with locks['pendings']:
+        # Clear old entries, so that any surviving entry is a valid one
+        expire_pendings(mirror, now)
+        expire_pendings(source, now)
+        # If found, ignore event
+        if entry in pendings[mirror]:
+            state['pendings_hits'] = state['pendings_hits'] + 1
+            log(utils.DEBUG1, source,
+                "File found. Backfired inotify event " + entry,
+                eventid=eventid)
+            if method == "MOVE":
+                log(utils.DEBUG2, source, "Removing: " + entry,
                     eventid=eventid)
                 pendings[mirror].pop(entry, None)
-        else:
-            # Clear old entries
-            if now-pendings[mirror][pending] >= config.pending_lifetime:
-                log(utils.DEBUG2, source, "Clearing stale entry " + pending)
-                pendings[mirror].pop(pending, None)
-    # Return True if found
-    # Return False and insert it into pending list if not found
-    if found:
-        return True
-    else:
+            return True
+        # If not found, insert it into pending list
+        state['pendings_misses'] = state['pendings_misses'] + 1
         log(utils.DEBUG2, source, "Inserting: " + entry, eventid=eventid)
-        pendings[source][entry] = time.time()
+        pendings[source][entry] = now
+        heapq.heappush(expiries[source],
+                       (now + config.pending_lifetime, entry))
         return False
 
 def delete(action):
@@ -245,11 +471,10 @@ def delete(action):
         eventid=action['eventid'])
     # Command selection
     if action['source'] == "L":
-        cmd = (["ssh"] + config.ssh_options +
-               [options.dsthost, "xargs", "-d", "'\n'",
-                config.helperbin, "-a", "DELETE"])
+        cmd = (ssh_command() +
+               [options.dsthost, config.helperbin, "-a", "DELETE", "-s"])
     else:
-        cmd = ["xargs", "-d", "\n", config.helperbin, "-a", "DELETE"]
+        cmd = [config.helperbin, "-a", "DELETE", "-s"]
     # Forced?
     for i in range(options.force):
         cmd.append("-f")
@@ -257,13 +482,13 @@ def delete(action):
     (protected, todelete) = check_delete(action['filelist'], action['source'])
     # Calculate and append checksum
     tohash = utils.concat("DELETE", todelete)
-    checksum = hashlib.md5(tohash).hexdigest()
-    cmd = cmd + ["-c", checksum]
+    cmd = cmd + ["-c", utils.hexdigest(tohash)]
     # Execute and report
     if todelete:
         log(utils.DEBUG2, action['source'], "Preparing to delete: \n" +
             todelete, eventid=action['eventid'])
-        execute(cmd, action['source'], todelete, eventid=action['eventid'])
+        execute(cmd, action['source'], todelete, eventid=action['eventid'],
+                command="DELETE")
     if protected:
         log(utils.INFO, action['source'], "Refusing to delete: \n" + protected,
             eventid=action['eventid'])
@@ -278,11 +503,10 @@ def move(action):
     # Command selection
     itemtype = action['itemtype']
     if action['source'] == "L":
-        cmd = (["ssh"] + config.ssh_options +
-               [options.dsthost, "xargs", "-d", "'\n'",
-                config.helperbin, "-a", "MOVE"])
+        cmd = (ssh_command() +
+               [options.dsthost, config.helperbin, "-a", "MOVE", "-s"])
     else:
-        cmd = ["xargs", "-d", "\n", config.helperbin, "-a", "MOVE"]
+        cmd = [config.helperbin, "-a", "MOVE", "-s"]
     # Forced?
     for i in range(options.force):
         cmd.append("-f")
@@ -291,14 +515,14 @@ def move(action):
     dstfile = action['dstfile']
     # Calculate and append checksum
     tohash = utils.concat("MOVE", utils.concat(srcfile, dstfile))
-    checksum = hashlib.md5(tohash).hexdigest()
-    cmd = cmd + ["-c", checksum]
+    cmd = cmd + ["-c", utils.hexdigest(tohash)]
     # Execute and report
     log(utils.DEBUG2, action['source'], "Preparing to move: \n" +
         srcfile + " -> " + dstfile, eventid=action['eventid'])
     (process, output, error) = execute(cmd, action['source'],
                                        utils.concat(srcfile, dstfile),
-                                       warn=False, eventid=action['eventid'])
+                                       warn=False, eventid=action['eventid'],
+                                       command="MOVE")
     if process.returncode:
         log(utils.INFO, action['source'], error, eventid=action['eventid'])
         log(utils.INFO, action['source'], "MOVE failed. Retrying with RSYNC",
@@ -329,6 +553,10 @@ def rsync(action, recurse=config.rsync_event_recurse, acl=False, warn=True,
         rsync_options.append(config.maxsize)
     if action['updateonly'] or updateonly:
         rsync_options.append("-u")
+    # Bandwidth share of the lane
+    (lease, kbps) = lease_bandwidth(action.get('lane', "small"))
+    if kbps:
+        rsync_options.append("--bwlimit=" + str(kbps))
     # Command selection
     if action['source'] == "L":
         left = options.srcroot
@@ -349,14 +577,99 @@ def rsync(action, recurse=config.rsync_event_recurse, acl=False, warn=True,
     # Execute and report
     log(utils.DEBUG2, action['source'], "Preparing to sync: \n" + filelist,
         eventid=action['eventid'])
-    cmd = (["rsync", "-ai"] + options.rsync_extra + rsync_options +
-           ["--files-from=-"] + excludelist + [left, right])
-    (process, output, error) = execute(cmd, action['source'], filelist,
-                                       warn=warn, eventid=action['eventid'])
-    if process.returncode == utils.RSYNC_TERMINATED:
-        log(utils.INFO, action['source'], "Rescheduling files: \n" + filelist,
-            eventid=action['eventid'])
-        actions.append(action)
+    cmd = (["rsync", "-ai", "--stats"] + options.rsync_extra +
+           rsync_options + ["-e", " ".join(ssh_command()), "--files-from=-"] +
+           excludelist + [left, right])
+    # The slow lane has no execute timeout
+    if action.get('lane') == "slow":
+        timeout = False
+    else:
+        timeout = heartbeats['execute']['default']['timeout']
+    started = time.time()
+    try:
+        (process, output, error) = execute(cmd, action['source'], filelist,
+                                           warn=warn, timeout=timeout,
+                                           eventid=action['eventid'],
+                                           command="rsync")
+    finally:
+        release_bandwidth(lease)
+    if 'batch' in action:
+        now = time.time()
+        log(utils.INFO, action['source'], "RSYNC batch of " +
+            str(action['batch']['size']) + " files (" +
+            action['batch']['reason'] + ") done in " +
+            "{0:.1f}".format(now - started) + "s, " +
+            "{0:.1f}".format(now - action['batch']['first']) +
+            "s after its first event", eventid=action['eventid'])
+    if process.returncode in utils.RSYNC_RETRY:
+        schedule_retry(action, process.returncode)
+    elif retries['attempts']:
+        forget_retries(action)
+
+
+def schedule_retry(action, code):
+    # Retry later, with exponential backoff and jitter. Paths which keep
+    # failing go to the slow lane, then are left to the next timed sync
+    source = action['source']
+    kept = []
+    slow = False
+    with locks['retries']:
+        for filename in utils.deconcat(action['filelist']):
+            key = (source, filename)
+            attempts = retries['attempts'].get(key, 0) + 1
+            if attempts > config.retry_max:
+                retries['attempts'].pop(key, None)
+                state['retry_giveups'] = state['retry_giveups'] + 1
+                log(utils.WARNING, source, "Giving up on " + filename +
+                    " after " + str(attempts - 1) + " retries. Leaving " +
+                    "it to the next timed sync", eventid=action['eventid'])
+                register_dir(source, os.path.dirname(filename.rstrip("/")))
+                continue
+            retries['attempts'][key] = attempts
+            kept.append(filename)
+            if attempts > config.retry_slow_after:
+                slow = True
+        if not kept:
+            return
+        attempts = max([retries['attempts'][(source, filename)]
+                        for filename in kept])
+        delay = min(config.retry_backoff * 2 ** (attempts - 1),
+                    config.retry_backoff_max) * random.uniform(0.5, 1.5)
+        action['filelist'] = "\n".join(kept)
+        # Not completed: a new seq is given when queued again
+        action['seq'] = None
+        # Without a slow lane, retries stay in their own lane
+        if (slow and action.get('lane') != "slow" and
+                "slow" in config.executor_lanes):
+            action['lane'] = "slow"
+            state['retry_escalations'] = state['retry_escalations'] + 1
+        retries['next'] = retries['next'] + 1
+        heapq.heappush(retries['heap'],
+                       (time.time() + delay, retries['next'], action))
+    log(utils.INFO, source, "rsync exit code " + str(code) + ". Retrying " +
+        "in " + "{0:.1f}".format(delay) + "s (attempt " + str(attempts) +
+        ", " + action['lane'] + " lane) files: \n" + action['filelist'],
+        eventid=action['eventid'])
+
+
+def forget_retries(action):
+    with locks['retries']:
+        for filename in utils.deconcat(action['filelist']):
+            retries['attempts'].pop((action['source'], filename), None)
+
+
+def release_retries():
+    # Queue again the actions whose retry is due
+    now = time.time()
+    due = []
+    with locks['retries']:
+        while retries['heap'] and retries['heap'][0][0] <= now:
+            due.append(heapq.heappop(retries['heap'])[2])
+    for action in due:
+        state['retries'] = state['retries'] + 1
+        log(utils.DEBUG1, action['source'], "Retrying files: \n" +
+            action['filelist'], eventid=action['eventid'])
+        enqueue(action, merge=False)
 
 
 def full_syncher(oneshot=False):
@@ -367,6 +680,10 @@ def full_syncher(oneshot=False):
         if oneshot:
             log(utils.INFO, "B", "INITIAL SYNC\n" +
                 "Please wait: this can take a long time")
+        elif state['fullsync_catchup']:
+            # Writes made while psync was down are in no journal
+            state['fullsync_catchup'] = False
+            log(utils.INFO, "B", "TIMED FULL SYNC: catching up after restart")
         else:
             time.sleep(3600)
             log(utils.DEBUG2, "B", "TIMED FULL SYNC: Waking up")
@@ -384,21 +701,31 @@ def full_syncher(oneshot=False):
             rsync_options.append("-b")
             rsync_options.append("--backup-dir="+config.backupdir)
             rsync_options.append("--suffix="+backupsuffix)
-        # Proceed
-        ldirs = "/"
-        rdirs = "/"
+        # Select dirs: everything on a true full pass, only the dirs touched
+        # since the last pass on an incremental one
+        dirty = take_dirty_dirs()
+        if (oneshot or not config.fullsync_incremental or
+                time.time() - state['fullsync_last'] >=
+                config.fullsync_full_interval * 3600 or "/" in dirty):
+            full = True
+            ldirs = "/"
+        else:
+            full = False
+            ldirs = "\n".join(sorted(dirty))
+            if not dirty:
+                log(utils.INFO, "B", "TIMED FULL SYNC: no dirty dirs. Skipping")
+                continue
+            log(utils.INFO, "B", "TIMED FULL SYNC: incremental pass on " +
+                str(len(dirty)) + " dirs")
         # Acquire lock
         locks['global'].acquire(False)
         # First sync, from L to R
         success = True  # Be optimistic ;)
-        excludelist = utils.gen_exclude(options.rsync_excludes)
-        cmd = (["rsync", "-airu"] + options.rsync_extra + rsync_options +
-               ["-u", "--files-from=-"] + excludelist +
-               [options.srcroot, options.dsthost + ":" + options.dstroot])
+        dirlist = utils.deconcat(ldirs)
+        shards = shard_dirs(dirlist)
         log(utils.INFO, "B",
             "Timed full sync from L to R started")
-        (process, output, error) = execute(cmd, "L", ldirs, timeout=False)
-        if process.returncode not in utils.RSYNC_SUCCESS:
+        if not sync_shards("L", dirlist, shards, rsync_options):
             success = False
         # Second sync, from R to L
         if config.acl_from_left_only:
@@ -406,15 +733,17 @@ def full_syncher(oneshot=False):
                 rsync_options.remove("-AX")
             except:
                 pass
-        cmd = (["rsync", "-airu"] + options.rsync_extra + rsync_options +
-               ["-u", "--files-from=-"] + excludelist +
-               [options.dsthost + ":" + options.dstroot, options.srcroot])
         log(utils.INFO, "B",
             "Timed full sync from R to L started")
-        (process, output, error) = execute(cmd, "R", rdirs, timeout=False)
-        if process.returncode not in utils.RSYNC_SUCCESS:
+        if not sync_shards("R", dirlist, shards, rsync_options):
             success = False
         log(utils.INFO, "B", "TIMED FULL SYNC: Ending")
+        # Take note of full passes, and retry failed dirs on the next pass
+        if success and full:
+            state['fullsync_last'] = time.time()
+        if not success:
+            for dirname in dirty:
+                register_dir("L", options.srcroot + dirname.lstrip("/"))
         # Release lock
         locks['global'].release()
         # If oneshot, return now
@@ -422,6 +751,371 @@ def full_syncher(oneshot=False):
             return success
 
 
+def toplevel_entries():
+    # Root-relative top level entries of both sides, minus rsync excludes.
+    # If a side can not be listed, the root itself: entries only found
+    # there must not drop out of the pass
+    try:
+        names = set(os.listdir(options.srcroot))
+    except OSError as error:
+        log(utils.WARNING, "L", "Can not list " + options.srcroot + ": " +
+            str(error) + ". Not sharding the full sync")
+        return ["/"]
+    cmd = ssh_command() + [options.dsthost, "ls", "-A",
+                           pipes.quote(options.dstroot)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    (output, error) = process.communicate()
+    if process.returncode or error:
+        log(utils.WARNING, "R", "Can not list " + options.dstroot +
+            " (exit code " + str(process.returncode) + "): " +
+            error.strip() + ". Not sharding the full sync")
+        return ["/"]
+    names.update(utils.deconcat(output))
+    entries = []
+    for name in names:
+        if not name:
+            continue
+        excluded = False
+        for pattern in options.rsync_excludes:
+            if fnmatch.fnmatch(name, pattern):
+                excluded = True
+        if not excluded:
+            entries.append("/" + name)
+    return entries
+
+
+def entry_weights(entries):
+    # Weight of entries, as seen on the left side: the names listed in
+    # each dir (one level only), or the file count or size of the whole
+    # tree, at the cost of a du walk
+    weights = dict([(entry, 1) for entry in entries])
+    if config.fullsync_shard_balance == "entries":
+        for entry in entries:
+            try:
+                weights[entry] = max(1, len(os.listdir(
+                    options.srcroot + entry.lstrip("/"))))
+            except OSError:
+                pass
+        return weights
+    paths = [options.srcroot + entry.lstrip("/") for entry in entries
+             if os.path.exists(options.srcroot + entry.lstrip("/"))]
+    if not paths:
+        return weights
+    if config.fullsync_shard_balance == "size":
+        cmd = ["du", "-s", "-k", "--"] + paths
+    else:
+        cmd = ["du", "-s", "--inodes", "--"] + paths
+    (output, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE).communicate()
+    for line in utils.deconcat(output):
+        try:
+            (weight, path) = line.split("\t", 1)
+            weights["/" + path[len(options.srcroot):]] = max(1, int(weight))
+        except ValueError:
+            continue
+    return weights
+
+
+def shard_dirs(dirlist):
+    # Split root-relative dirs into at most fullsync_shards balanced shards
+    if config.fullsync_shards < 2:
+        return [dirlist]
+    entries = []
+    for dirname in dirlist:
+        if dirname == "/":
+            entries.extend(toplevel_entries())
+        else:
+            entries.append(dirname)
+    if not entries:
+        return [dirlist]
+    # Largest first, each one to the least loaded shard
+    weights = entry_weights(entries)
+    shards = []
+    loads = []
+    for entry in sorted(entries, key=lambda entry: -weights[entry]):
+        if len(shards) < config.fullsync_shards:
+            shards.append([entry])
+            loads.append(weights[entry])
+            continue
+        lightest = loads.index(min(loads))
+        shards[lightest].append(entry)
+        loads[lightest] = loads[lightest] + weights[entry]
+    for i in range(len(shards)):
+        log(utils.DEBUG1, "B", "Shard " + str(i + 1) + "/" + str(len(shards)) +
+            ": " + str(len(shards[i])) + " entries, weight " + str(loads[i]))
+    return shards
+
+
+def sync_shard(source, shard, rsync_options, results, index, total,
+               recurse=True):
+    if source == "L":
+        src = options.srcroot
+        dst = options.dsthost + ":" + options.dstroot
+    else:
+        src = options.dsthost + ":" + options.dstroot
+        dst = options.srcroot
+    excludelist = utils.gen_exclude(options.rsync_excludes)
+    (lease, kbps) = lease_bandwidth("fullsync")
+    if kbps:
+        rsync_options = rsync_options + ["--bwlimit=" + str(kbps)]
+    # Not recursive: the root dir itself and its top level entries
+    if recurse:
+        flags = "-airu"
+    else:
+        flags = "-aidu"
+    cmd = (["rsync", flags, "--stats"] + options.rsync_extra +
+           rsync_options + ["-e", " ".join(ssh_command()), "-u",
+                            "--files-from=-"] + excludelist + [src, dst])
+    if total > 1:
+        log(utils.INFO, source, "Shard " + str(index + 1) + "/" + str(total) +
+            " started: " + str(len(shard)) + " entries")
+    started = time.time()
+    results['running'][index] = {'started': started}
+    try:
+        (process, output, error) = execute(
+            cmd, source, "\n".join(shard), timeout=False, command="rsync",
+            launched=results['running'][index].update)
+    finally:
+        results['running'].pop(index, None)
+        release_bandwidth(lease)
+    results[index] = process.returncode in utils.RSYNC_SUCCESS
+    if total > 1:
+        elapsed = max(time.time() - started, 0.001)
+        stats = utils.parse_rsync_stats(output)
+        with results['lock']:
+            results['done'] = results['done'] + 1
+        log(utils.INFO, source, "Shard " + str(index + 1) + "/" + str(total) +
+            " ended with exit code " + str(process.returncode) + " in " +
+            "{0:.1f}".format(elapsed) + "s: " + str(stats['files']) +
+            " files, " + str(stats['bytes']) + " bytes, " +
+            "{0:.1f}".format(stats['bytes'] / 1024.0 / elapsed) + " KB/s (" +
+            str(results['done']) + "/" + str(total) + " shards done)")
+
+
+def sync_shards(source, dirlist, shards, rsync_options):
+    # Run one rsync per shard of dirlist, concurrently
+    results = {'done': 0, 'lock': threading.Lock(), 'running': {}}
+    threads = []
+    for i in range(len(shards)):
+        thread = threading.Thread(name="shard" + str(i), target=sync_shard,
+                                  args=(source, shards[i], rsync_options,
+                                        results, i, len(shards)))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Long passes log their progress
+    reported = time.time()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+            if time.time() - reported >= config.fullsync_progress_interval:
+                shard_progress(source, results, len(shards))
+                reported = time.time()
+    success = all([results.get(i) for i in range(len(shards))])
+    # Sharded by top level entries: the root dir itself (its attributes,
+    # top level entries created since they were listed) is synched by a
+    # last, non recursive, rsync
+    if "/" in dirlist and not [shard for shard in shards if "/" in shard]:
+        root = {'done': 0, 'lock': threading.Lock(), 'running': {}}
+        sync_shard(source, ["/"], rsync_options, root, 0, 1, recurse=False)
+        success = success and root[0]
+    return success
+
+
+def shard_progress(source, results, total):
+    # Elapsed time and I/O of the running rsyncs
+    for index in sorted(results['running'].keys()):
+        running = results['running'].get(index)
+        if not running:
+            continue
+        elapsed = max(time.time() - running['started'], 0.001)
+        counters = {}
+        if running.get('process'):
+            counters = process_io(running['process'].pid)
+        message = ("Shard " + str(index + 1) + "/" + str(total) +
+                   " running for " + "{0:.0f}".format(elapsed) + "s")
+        if counters:
+            message = (message + ": " + str(counters['rchar'] / 1024) +
+                       " KB read, " + str(counters['wchar'] / 1024) +
+                       " KB written, " + "{0:.1f}".format(
+                           (counters['rchar'] + counters['wchar']) /
+                           1024.0 / elapsed) + " KB/s")
+        log(utils.INFO, source, message + " (" + str(results['done']) + "/" +
+            str(total) + " shards done)")
+
+
+def process_io(pid):
+    # Bytes read and written by a process, from /proc. Empty if unknown
+    counters = {}
+    try:
+        with open("/proc/" + str(pid) + "/io") as fd:
+            for line in fd:
+                (name, value) = line.split(":", 1)
+                counters[name] = int(value)
+    except (IOError, ValueError):
+        return {}
+    if 'rchar' not in counters or 'wchar' not in counters:
+        return {}
+    return counters
+
+
+def bandwidth_limits(hour):
+    # KB/s caps (0: none) of all rsyncs, of full syncs and of each lane,
+    # as scheduled for this hour
+    limits = {'all': config.bwlimit, 'fullsync': config.bwlimit_fullsync}
+    for lane in config.executor_lanes:
+        limits[lane] = config.executor_lanes[lane]['bwlimit']
+    for (first, last, name, kbps) in schedules['bandwidth']['hours']:
+        if first <= last:
+            current = first <= hour <= last
+        else:
+            current = hour >= first or hour <= last
+        if current:
+            limits[name] = kbps
+    return limits
+
+
+def bandwidth_slots(name):
+    # How many rsyncs of a class can run at once
+    if name == "fullsync":
+        return max(config.fullsync_shards, 1)
+    if name == "all":
+        return (sum(lane['workers'] for lane in
+                    config.executor_lanes.values()) +
+                bandwidth_slots("fullsync"))
+    return max(config.executor_lanes.get(name, {}).get('workers', 1), 1)
+
+
+def lease_bandwidth(name):
+    # rsync enforces its own --bwlimit, fixed at start: every lease is sized
+    # from the ones held on a cap, taking half of what is left (all of it
+    # for the last rsync the class can run at once), so that a lone rsync
+    # uses half the link and leases never add up to more than the cap. Full
+    # syncs count against "all" but never take the part of it kept for the
+    # realtime lanes. With nothing left, wait for a release
+    with conditions['bandwidth']:
+        while True:
+            limits = bandwidth_limits(int(time.strftime("%H")))
+            leases = bandwidth['leases'].values()
+            kbps = 0
+            for other in [name, "all"]:
+                cap = limits.get(other, 0)
+                if not cap:
+                    continue
+                held = [leased for (leaser, leased) in leases
+                        if other == "all" or leaser == other]
+                left = cap - sum(held)
+                slots = bandwidth_slots(other)
+                if other == "all" and name == "fullsync":
+                    realtime = sum(leased for (leaser, leased) in leases
+                                   if leaser != "fullsync")
+                    reserve = cap - cap * bandwidth_slots(name) // slots
+                    left = left - max(reserve - realtime, 0)
+                    held = [leased for (leaser, leased) in leases
+                            if leaser == name]
+                    slots = bandwidth_slots(name)
+                if len(held) + 1 >= slots:
+                    share = left
+                else:
+                    share = min(max(left // 2, 1), left)
+                if share < 1:
+                    kbps = None
+                    break
+                if not kbps or share < kbps:
+                    kbps = share
+            if kbps is not None:
+                break
+            log(utils.DEBUG1, "B", "Bandwidth of %s fully leased, waiting",
+                args=(other,))
+            conditions['bandwidth'].wait(1)
+        bandwidth['next'] = bandwidth['next'] + 1
+        bandwidth['leases'][bandwidth['next']] = (name, kbps)
+        lease = bandwidth['next']
+    log(utils.DEBUG1, "B", "Bandwidth lease for %s: %d KB/s",
+        args=(name, kbps))
+    return (lease, kbps)
+
+
+def release_bandwidth(lease):
+    with conditions['bandwidth']:
+        bandwidth['leases'].pop(lease, None)
+        conditions['bandwidth'].notify_all()
+
+
+def ssh_command(pooled=True):
+    # Round-robin between live control connections. If none is available,
+    # or for long-lived sessions which would hold a channel of the pool,
+    # fall back to a plain (full handshake) ssh connection
+    if not pooled:
+        with locks['sshpool']:
+            state['ssh_handshakes'] = state['ssh_handshakes'] + 1
+        return ["ssh"] + config.ssh_options + ["-o", "ControlPath=none"]
+    with locks['sshpool']:
+        channels = sshpool['channels']
+        for i in range(len(channels)):
+            channel = channels[(sshpool['next'] + i) % len(channels)]
+            if (channel['process'] and channel['process'].poll() is None and
+                    os.path.exists(channel['path'])):
+                sshpool['next'] = sshpool['next'] + i + 1
+                state['ssh_handshakes_avoided'] = (
+                    state['ssh_handshakes_avoided'] + 1)
+                return (["ssh"] + config.ssh_options +
+                        ["-o", "ControlMaster=no",
+                         "-o", "ControlPath=" + channel['path']])
+        state['ssh_handshakes'] = state['ssh_handshakes'] + 1
+    return ["ssh"] + config.ssh_options
+
+
+def ssh_connect(channel):
+    # Remove any stale control socket
+    try:
+        os.unlink(channel['path'])
+    except:
+        pass
+    cmd = (["ssh"] + config.ssh_options +
+           ["-o", "ControlMaster=yes", "-o", "ControlPath=" + channel['path'],
+            "-o", "ServerAliveInterval=10", "-o", "ServerAliveCountMax=3",
+            "-N", options.dsthost])
+    devnull = open(os.devnull, "r+")
+    channel['process'] = subprocess.Popen(cmd, stdin=devnull, stdout=devnull)
+    devnull.close()
+    state['ssh_handshakes'] = state['ssh_handshakes'] + 1
+    log(utils.DEBUG1, "R", "STARTED SSH CONTROL CONNECTION PID " +
+        str(channel['process'].pid) + " ON " + channel['path'])
+
+
+def ssh_supervise():
+    if not config.ssh_mux_dir or options.dryrun:
+        return
+    # First run: prepare control sockets
+    if not sshpool['channels']:
+        if not os.path.isdir(config.ssh_mux_dir):
+            os.makedirs(config.ssh_mux_dir, 0700)
+        for i in range(config.ssh_mux_channels):
+            path = config.ssh_mux_dir + options.dsthost + "-" + str(i)
+            sshpool['channels'].append({'path': path, 'process': None})
+    # (Re)start dead control connections
+    for channel in sshpool['channels']:
+        if channel['process'] and channel['process'].poll() is None:
+            continue
+        if channel['process']:
+            state['ssh_reconnects'] = state['ssh_reconnects'] + 1
+            log(utils.WARNING, "R",
+                "Lost SSH control connection " + channel['path'] +
+                ". Reconnecting... (handshakes avoided so far: " +
+                str(state['ssh_handshakes_avoided']) + ")")
+        ssh_connect(channel)
+
+
+def ssh_disconnect():
+    for channel in sshpool['channels']:
+        try:
+            channel['process'].terminate()
+        except:
+            pass
+
+
 def connect_left():
     try:
         left.kill()
@@ -435,6 +1129,7 @@ def connect_left():
     cmd = [config.filterbin, "--srcroot", options.srcroot,
            "-d", str(options.debug),
            "-e", options.excludes,
+           "-P", config.filter_protocol,
            "-k"]
     # Other options
     if options.tempfiles:
@@ -461,14 +1156,16 @@ def connect_right():
     except:
         pass
     # Kill any leftover
-    cmd = (["ssh"] + config.ssh_options + [options.dsthost] +
+    cmd = (ssh_command() + [options.dsthost] +
            ["killall", "-q", "filter.py"])
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()
-    # Prepare filter command
-    cmd = (["ssh"] + config.ssh_options + [options.dsthost] +
+    # Prepare filter command, on a connection of its own: it lives as long
+    # as psync, and would hold a pooled channel for good
+    cmd = (ssh_command(pooled=False) + [options.dsthost] +
            [config.filterbin, "--srcroot", options.dstroot,
             "-d", str(options.debug),
             "-e", "'" + options.excludes + "'",
+            "-P", config.filter_protocol,
             "-k"])
     # Other options
     if options.tempfiles:
@@ -533,20 +1230,87 @@ def beat_inotify(source):
 
 
 def register_dir(source, dirname):
-    dirs[source][utils.normalize_dir(dirname)] = True
+    dirname = utils.normalize_dir(dirname)
+    with locks['dirs']:
+        if dirname in dirs[source]:
+            return
+        dirs[source][dirname] = True
     log(utils.DEBUG2, source,
         "Registering directory for later check: " + dirname)
 
 
 def unregister_dir(source, dirname):
     mirror = mirror = get_mirror(source)
-    dirs[source].pop(utils.normalize_dir(dirname), None)
-    dirs[mirror].pop(utils.normalize_dir(dirname), None)
+    with locks['dirs']:
+        dirs[source].pop(utils.normalize_dir(dirname), None)
+        dirs[mirror].pop(utils.normalize_dir(dirname), None)
     log(utils.DEBUG2, source,
         "Unregistering directory from later check: " + dirname)
 
 
+def take_dirty_dirs():
+    # Return and clear registered dirs of both sides, as a minimal set of
+    # root-relative dirs ("/" meaning the whole tree)
+    with locks['dirs']:
+        taken = {'L': dirs['L'], 'R': dirs['R']}
+        dirs['L'] = {}
+        dirs['R'] = {}
+    dirty = set()
+    for source in taken:
+        for dirname in taken[source]:
+            dirty.add(relpath(source, dirname))
+    if "/" in dirty:
+        return set(["/"])
+    return set([dirname for dirname in dirty
+                if not [parent for parent in utils.ancestors(dirname)
+                        if parent in dirty]])
+
+
 def reader(process, source="B"):
+    if config.filter_protocol == "framed":
+        read_frames(process, source)
+    else:
+        read_lines(process, source)
+
+
+def read_frames(process, source):
+    while True:
+        try:
+            frame = utils.read_frame(process.stdout)
+        except ValueError as error:
+            log(utils.ERROR, source, "Invalid frame: " + str(error))
+            return
+        # Filter exited
+        if not frame:
+            return
+        (channel, records) = frame
+        if channel == utils.FRAME_HEART:
+            beat_inotify(source)
+            log(utils.DEBUG2, source, "heartbeat")
+        elif channel == utils.FRAME_LOG:
+            for (severity, caller, message) in records:
+                log(severity, source, "[" + caller + "] " + message, 1)
+        elif channel == utils.FRAME_STATS:
+            filter_report(source, records[0])
+        elif channel == utils.FRAME_EVENT:
+            for fields in records:
+                if not are_ready():
+                    log(utils.ERROR, source, "Not connected, ignoring " +
+                        "event: " + config.separator.join(fields))
+                    continue
+                if len(fields) != 7:
+                    log(utils.WARNING, source, "Rogue event: " +
+                        config.separator.join(fields))
+                    continue
+                eventid = "{0:05x}".format(
+                    zlib.crc32("\0".join(fields)) & 0xfffff)
+                accept_event(source, fields, eventid)
+        else:
+            log(utils.WARNING, source, "Ignoring frame on unknown channel " +
+                str(channel))
+
+
+def read_lines(process, source):
     rogue = 0
     while True:
         # Select variables based on event source
@@ -558,7 +1322,7 @@ def reader(process, source="B"):
         line = process.stdout.readline()
         line = line.strip(" \n")
         # If it is a log, print it
-        match = re.match("^\[(.*?)\] \[(.*?):(.*?)\] \[(.*?)\]", line)
+        match = logline.match(line)
         if match:
             severity = match.group(3)
             line = line[len(match.group()) + 1:]
@@ -575,6 +1339,11 @@ def reader(process, source="B"):
             beat_inotify(source)
             log(utils.DEBUG2, source, "heartbeat")
             continue
+        # If STATS, take note and continue
+        if line.startswith("STATS" + config.separator):
+            filter_report(source,
+                          utils.deconcat(line, config.separator)[1:])
+            continue
         # Check if connected
         if not are_ready():
             if len(line) > 0:
@@ -582,8 +1351,8 @@ def reader(process, source="B"):
                     "Not connected, ignoring event: " + line)
             continue
         # Be sure to process a good formed line
-        nfields = 6
-        match = re.match("^(RSYNC|MOVE|DELETE|NONE)", line, flags=re.I)
+        nfields = 7
+        match = eventline.match(line)
         if not match or line.count(config.separator) != nfields:
             log(utils.WARNING, source,
                 "Rogue line (n." + str(rogue) + "): " + line)
@@ -595,13 +1364,7 @@ def reader(process, source="B"):
         else:
             rogue = 0
         entry = utils.deconcat(line, config.separator)
-        method = entry[0]
-        itemtype = entry[1]
-        parent = utils.normalize_dir(entry[2])
-        srcfile = entry[3]
-        dstfile = entry[4]
-        flags = entry[5]
-        checksum = entry[6]
+        checksum = entry[7]
         # Validate checksum
         computed = line[:-len(config.separator + checksum)]
         computed = hashlib.md5(computed).hexdigest()
@@ -612,70 +1375,934 @@ def reader(process, source="B"):
                 "Received: " + checksum + " - Computed: " + computed)
             continue
         else:
-            log(utils.DEBUG2, source, "Checksum ok. Received: " +
-                checksum + " - Computed: " + computed)
-        # Beat the heart
-        beat_inotify(source)
-        # If method is NONE, continue reading
-        if method == "NONE":
-            log(utils.INFO, source, "Ignoring event NONE for file: " + srcfile)
+            log(utils.DEBUG2, source,
+                "Checksum ok. Received: %s - Computed: %s",
+                args=(checksum, computed))
+        accept_event(source, entry[:7], checksum[-5:])
+
+
+def accept_event(source, fields, eventid):
+    # Once connected, queue unfinished actions of the previous run ahead
+    # of new events (on an idle share, the main loop does it)
+    if journal['replay']:
+        journal_replay()
+    method = fields[0]
+    itemtype = fields[1]
+    parent = utils.normalize_dir(fields[2])
+    srcfile = fields[3]
+    dstfile = fields[4]
+    flags = fields[5]
+    meta = parse_fields(fields[6].split(","))
+    # Beat the heart
+    beat_inotify(source)
+    arrival = time.time()
+    # If method is NONE, ignore it
+    if method == "NONE":
+        log(utils.INFO, source, "Ignoring event NONE for file: " + srcfile)
+        return
+    # Parse event
+    log(utils.DEBUG1, source, "Read event: %s",
+        args=(config.separator.join(fields),))
+    # Pending checks
+    if method in config.pending_events:
+        backfired = check_pendings(source, srcfile, method)
+    else:
+        backfired = False
+    if backfired:
+        if method == "RSYNC" and config.rsync_style > 1:
+            log(utils.DEBUG1, source, "Ignoring backfired event "+method+
+                config.separator + srcfile)
+        return
+    # Touched dirs are checked again by the next timed sync. A DIRTY
+    # event (ie: lost inotify events) only marks its dir
+    register_dir(source, parent)
+    if method == "MOVE":
+        register_dir(source, os.path.dirname(dstfile.rstrip("/")))
+    if method == "DIRTY":
+        log(utils.INFO, source, "Lost events for " + srcfile +
+            ". Marking it for the next timed sync")
+        register_dir(source, srcfile)
+        return
+    # Normalize dir
+    if itemtype == "DIR":
+        srcfile = utils.normalize_dir(srcfile)
+        if method == "MOVE":
+            dstfile = utils.normalize_dir(dstfile)
+    # A dir whose events were collapsed by the filter is synched
+    # recursively, as the timed sync would do
+    recurse = flags == utils.FRECURSE
+    entry = {'source': source, 'method': method, 'itemtype': itemtype,
+             'filelist': srcfile, 'dstfile': dstfile,
+             'eventid': eventid, 'backfired': backfired,
+             'flags': flags, 'recurse': recurse, 'updateonly': recurse,
+             'size': int(meta.get('s', 0)), 'arrivals': [arrival]}
+    # Time spent in the filter, and to get here
+    trace_filter(entry, meta, arrival)
+    # Take note of the event, so that it survives a restart
+    journal_accept(entry)
+    # Keep the queue bounded
+    entry = admit(entry)
+    if not entry:
+        return
+    # If batched rsync is true, collect RSYNC events for later.
+    # Any other event flushes the pending batches of its side first,
+    # so that it can not overtake them
+    if config.rsync_style == 3:
+        if method == "RSYNC" and not entry['recurse']:
+            batch_event(entry)
+            return
+        flush_batches(source, "barrier")
+    enqueue(entry)
+
+
+def index_action(action, paths=None, count=1):
+    # Add (count=1) or remove (count=-1) action from the coalescing index
+    if paths is None:
+        paths = action_paths(action)
+    for path in paths:
+        key = (action['source'], os.path.dirname(path))
+        queued['dirs'][key] = queued['dirs'][key] + count
+        if queued['dirs'][key] <= 0:
+            del queued['dirs'][key]
+        if count > 0:
+            queued['paths'].setdefault(path, []).append(action)
+            # Anything but an RSYNC queued in (or above) a collapsed dir
+            # must not be overtaken by later events folded into it
+            if action['method'] != "RSYNC":
+                for key in [path] + utils.ancestors(path):
+                    queued['collapsed'].pop((action['source'], key), None)
             continue
-        # Parse event
-        log(utils.DEBUG1, source, "Read event: " + line)
-        # Pending checks
-        if method in config.pending_events:
-            backfired = check_pendings(source, srcfile, method)
+        holders = queued['paths'].get(path, [])
+        for i in range(len(holders)):
+            if holders[i] is action:
+                del holders[i]
+                break
+        if not holders:
+            queued['paths'].pop(path, None)
+
+
+def latest_action(path):
+    holders = queued['paths'].get(path)
+    if holders:
+        return holders[-1]
+    return None
+
+
+def touched_after(paths, seq):
+    # Is any of these paths, or their ancestors, touched by an action
+    # queued after seq?
+    for path in paths:
+        for key in [path] + utils.ancestors(path):
+            action = latest_action(key)
+            if action and action['seq'] > seq:
+                return True
+    return False
+
+
+def remove_file(action, path):
+    # Remove a (root-relative) path from a queued action
+    filelist = [filename for filename in utils.deconcat(action['filelist'])
+                if relpath(action['source'], filename) != path]
+    action['filelist'] = "\n".join(filelist)
+    index_action(action, [path], -1)
+    if not filelist:
+        action['cancelled'] = True
+
+
+def absorb(action, entry):
+    # Entry completes together with action
+    action['journal'] = action.get('journal', []) + entry.get('journal', [])
+    action['arrivals'] = (action.get('arrivals', []) +
+                          entry.get('arrivals', []))
+    # A file which grew moves to the large lane
+    if entry.get('lane') == "large" and action['method'] == "RSYNC":
+        action['lane'] = "large"
+
+
+def coalesce(entry):
+    # Fold entry into the queued actions. Return False if nothing is left
+    # to be queued
+    source = entry['source']
+    method = entry['method']
+    path = relpath(source, entry['filelist'])
+    prev = latest_action(path)
+    # Only same-side actions which nothing else overtook can be folded
+    if (not prev or prev['source'] != source or
+            touched_after(utils.ancestors(path), prev['seq'])):
+        return True
+    if method == "RSYNC":
+        if (prev['method'] == "RSYNC" and prev['flags'] == entry['flags'] and
+                prev['backfired'] == entry['backfired']):
+            log(utils.DEBUG1, source, "Coalescing duplicate RSYNC for " +
+                entry['filelist'], eventid=entry['eventid'])
+            state['coalesced_duplicates'] = state['coalesced_duplicates'] + 1
+            absorb(prev, entry)
+            return False
+        if prev['method'] == "DELETE":
+            log(utils.DEBUG1, source, "Cancelling queued DELETE for " +
+                entry['filelist'], eventid=entry['eventid'])
+            state['coalesced_cancels'] = state['coalesced_cancels'] + 1
+            remove_file(prev, path)
+    elif method == "DELETE":
+        if prev['method'] == "DELETE":
+            log(utils.DEBUG1, source, "Coalescing duplicate DELETE for " +
+                entry['filelist'], eventid=entry['eventid'])
+            state['coalesced_duplicates'] = state['coalesced_duplicates'] + 1
+            absorb(prev, entry)
+            return False
+        if prev['method'] == "RSYNC":
+            log(utils.DEBUG1, source, "Cancelling queued RSYNC for " +
+                entry['filelist'], eventid=entry['eventid'])
+            state['coalesced_cancels'] = state['coalesced_cancels'] + 1
+            remove_file(prev, path)
+    elif method == "MOVE":
+        # Chained MOVEs: A->B, B->C become A->C, A->B, B->A nothing. Had B
+        # existed, A->B replaced it and B->C took it away: whatever the
+        # destination may still hold at B is deleted, after the fold
+        dstpath = relpath(source, entry['dstfile'])
+        if (prev['method'] == "MOVE" and
+                relpath(source, prev['dstfile']) == path and
+                not touched_after([dstpath], prev['seq'])):
+            log(utils.DEBUG1, source, "Folding MOVE " + prev['filelist'] +
+                " -> " + prev['dstfile'] + " -> " + entry['dstfile'],
+                eventid=entry['eventid'])
+            state['coalesced_moves'] = state['coalesced_moves'] + 1
+            absorb(prev, entry)
+            index_action(prev, [path], -1)
+            prev['dstfile'] = entry['dstfile']
+            index_action(prev, [dstpath])
+            # Moved back to where it was
+            if relpath(source, prev['filelist']) == dstpath:
+                index_action(prev, count=-1)
+                prev['cancelled'] = True
+            # Both MOVEs complete with the fold, the DELETE is not journaled:
+            # replaying B->C after A->C would clobber C
+            entry['method'] = "DELETE"
+            entry['dstfile'] = ""
+            entry['journal'] = []
+            entry['arrivals'] = []
+    return True
+
+
+def merge_target(entry):
+    # Latest queued action of the same kind entry can be merged into
+    if entry['method'] not in ["RSYNC", "DELETE"]:
+        return None
+    # Big transfers gain nothing from sharing an rsync, and would not
+    # run in parallel
+    if entry['lane'] == "large":
+        return None
+    if os.path.islink(entry['filelist']):
+        return None
+    key = (entry['source'], entry['method'], entry['flags'],
+           entry['backfired'], entry['lane'])
+    target = queued['tails'].get(key)
+    if not target or target.get('cancelled'):
+        return None
+    # Tail merge, as always
+    if actions and actions[-1] is target:
+        return target
+    # Merging earlier in the queue is safe only for plain files
+    # no later action depends on
+    if entry['itemtype'] != "FILE":
+        return None
+    if touched_after([relpath(entry['source'], entry['filelist'])],
+                     target['seq']):
+        return None
+    return target
+
+
+def enqueue(entry, merge=True):
+    if 'lane' not in entry:
+        entry['lane'] = lane_of(entry)
+    with locks['actions']:
+        queued['seq'] = queued['seq'] + 1
+        entry['seq'] = queued['seq']
+        if not merge:
+            actions.append(entry)
+            index_action(entry)
+        elif coalesce(entry):
+            target = merge_target(entry)
+            if target:
+                target['filelist'] = utils.concat(target['filelist'],
+                                                  entry['filelist'])
+                absorb(target, entry)
+                index_action(target, [relpath(entry['source'],
+                                              entry['filelist'])])
+                state['current_merges'] = state['current_merges'] + 1
+            else:
+                state['current_merges'] = 0
+                actions.append(entry)
+                index_action(entry)
+                key = (entry['source'], entry['method'], entry['flags'],
+                       entry['backfired'], entry['lane'])
+                queued['tails'][key] = entry
+            log(utils.DEBUG1, entry['source'],
+                "Current merges: %d", args=(state['current_merges'],))
+    # Wake up the dispatcher
+    wakeup()
+
+
+def wakeup():
+    with conditions['executor']:
+        conditions['executor'].notify()
+
+
+def unqueue():
+    # Pop the first live action and drop it from the coalescing index
+    with locks['actions']:
+        while actions:
+            action = actions.popleft()
+            for key in queued['tails'].keys():
+                if queued['tails'][key] is action:
+                    queued['tails'].pop(key)
+            if action.get('cancelled'):
+                journal_done(action.get('journal'))
+                continue
+            index_action(action, count=-1)
+            key = action.get('collapsed')
+            if key and queued['collapsed'].get(key) is action:
+                queued['collapsed'].pop(key)
+            check_watermarks()
+            return action
+    return None
+
+
+def check_watermarks():
+    # Enter or leave degraded mode. Call with actions lock held
+    depth = len(queued['paths'])
+    if not state['queue_degraded'] and depth >= config.queue_high_watermark:
+        state['queue_degraded'] = True
+        state['queue_degraded_since'] = time.time()
+        state['queue_degradations'] = state['queue_degradations'] + 1
+        log(utils.WARNING, "B", "Actions queue over its high watermark (" +
+            str(depth) + " paths): collapsing RSYNC events into " +
+            "recursive RSYNCs of their dirs")
+    elif state['queue_degraded'] and depth <= config.queue_low_watermark:
+        state['queue_degraded'] = False
+        log(utils.WARNING, "B", "Actions queue under its low watermark (" +
+            str(depth) + " paths) after " +
+            "{0:.1f}".format(time.time() - state['queue_degraded_since']) +
+            "s: back to per-file RSYNC events")
+    return depth
+
+
+def admit(entry):
+    # Keep the actions queue bounded. RSYNC events of a crowded dir, or
+    # of any dir while the queue is over its high watermark, collapse into
+    # a single recursive RSYNC of their dir. Over queue_max they are
+    # dropped: their dir is already marked for the next timed sync.
+    # Return the entry if it still has to be queued
+    if (entry['method'] != "RSYNC" or entry['recurse'] or
+            entry['backfired']):
+        return entry
+    source = entry['source']
+    dirname = utils.normalize_dir(os.path.dirname(
+        entry['filelist'].rstrip("/")))
+    key = (source, relpath(source, dirname))
+    with locks['actions']:
+        if check_watermarks() >= config.queue_max:
+            log(utils.DEBUG1, source, "Actions queue full, dropping RSYNC " +
+                "for " + entry['filelist'], eventid=entry['eventid'])
+            state['queue_dropped'] = state['queue_dropped'] + 1
+            journal_done(entry.get('journal'))
+            return None
+        if (not state['queue_degraded'] and
+                queued['dirs'][key] < config.queue_dir_collapse):
+            return entry
+        state['queue_collapsed'] = state['queue_collapsed'] + 1
+        collapsed = queued['collapsed'].get(key)
+        if collapsed:
+            absorb(collapsed, entry)
+            return None
+        if state['queue_degraded']:
+            log(utils.DEBUG1, source, "Queue degraded, collapsing events " +
+                "for " + dirname + " into a recursive RSYNC",
+                eventid=entry['eventid'])
+        else:
+            log(utils.INFO, source, "Too many queued events (" +
+                str(queued['dirs'][key]) + ") for " + dirname +
+                ", collapsing them into a recursive RSYNC",
+                eventid=entry['eventid'])
+        collapsed = {'source': source, 'method': "RSYNC", 'itemtype': "DIR",
+                     'filelist': dirname, 'dstfile': "",
+                     'eventid': entry['eventid'], 'backfired': False,
+                     'flags': entry['flags'], 'recurse': True,
+                     'updateonly': True, 'collapsed': key,
+                     'journal': entry.get('journal', []),
+                     'arrivals': entry.get('arrivals', [])}
+        queued['seq'] = queued['seq'] + 1
+        collapsed['seq'] = queued['seq']
+        actions.append(collapsed)
+        index_action(collapsed)
+        queued['collapsed'][key] = collapsed
+    wakeup()
+    return None
+
+
+def batch_event(entry):
+    source = entry['source']
+    key = (entry['flags'], lane_of(entry))
+    with locks['batches']:
+        batch = batches[source].get(key)
+        if not batch:
+            batch = {'files': collections.OrderedDict(), 'first': time.time(),
+                     'eventid': entry['eventid'], 'journal': [],
+                     'arrivals': []}
+            batches[source][key] = batch
+        batch['files'][entry['filelist']] = True
+        batch['journal'].extend(entry.get('journal', []))
+        batch['arrivals'].extend(entry.get('arrivals', []))
+        full = len(batch['files']) >= config.rsync_batch_size
+    if full:
+        flush_batches(source, "size")
+
+
+def flush_batches(source, reason=None):
+    # Without a reason, flush only batches older than rsync_batch_window.
+    # Batches are queued once the batches lock is released, the flush
+    # lock keeps them ahead of the events which flushed them
+    now = time.time()
+    flushed = []
+    with locks['flush']:
+        with locks['batches']:
+            for key in batches[source].keys():
+                flushed.append(flush_batch(source, key, reason, now))
+        for entry in flushed:
+            if entry:
+                enqueue(entry, merge=False)
+
+
+def flush_batch(source, key, reason, now):
+    # Pop a batch and return its RSYNC entry, None if it is not expired.
+    # Call with batches lock held
+    (flags, lane) = key
+    batch = batches[source][key]
+    if not reason and now - batch['first'] < config.rsync_batch_window:
+        return None
+    batches[source].pop(key)
+    log(utils.INFO, source, "Flushing RSYNC batch of " +
+        str(len(batch['files'])) + " files after " +
+        "{0:.1f}".format(now - batch['first']) + "s - reason: " +
+        (reason or "window"), eventid=batch['eventid'])
+    return {'source': source, 'method': "RSYNC", 'itemtype': "FILE",
+            'filelist': "\n".join(batch['files']), 'dstfile': "",
+            'eventid': batch['eventid'], 'backfired': False,
+            'flags': flags, 'recurse': False, 'updateonly': False,
+            'lane': lane,
+            'batch': {'size': len(batch['files']),
+                      'reason': reason or "window",
+                      'first': batch['first']},
+            'journal': batch['journal'],
+            'arrivals': batch['arrivals']}
+
+
+def journal_accept(entry):
+    entry['journal'] = []
+    if not config.journal_dir:
+        return
+    record = config.separator.join(
+        [entry['source'], entry['method'], entry['itemtype'], entry['flags'],
+         str(entry['backfired']), entry['eventid'], entry['filelist'],
+         entry['dstfile']])
+    with locks['journal']:
+        journal['id'] = journal['id'] + 1
+        journal['live'][journal['id']] = record
+        journal['buffer'].append("A" + config.separator +
+                                 str(journal['id']) + config.separator +
+                                 record)
+        entry['journal'] = [journal['id']]
+
+
+def journal_done(ids):
+    if not ids or not config.journal_dir:
+        return
+    with locks['journal']:
+        for journalid in ids:
+            journal['live'].pop(journalid, None)
+        journal['buffer'].append("D" + config.separator +
+                                 ",".join([str(i) for i in ids]))
+
+
+def journal_load():
+    # Load unfinished events of the previous run.
+    # Return True if they can replace the initial full sync
+    if not config.journal_dir:
+        return False
+    if not os.path.isdir(config.journal_dir):
+        os.makedirs(config.journal_dir, 0700)
+    filename = config.journal_dir + "journal"
+    trusted = False
+    try:
+        age = time.time() - os.stat(filename).st_mtime
+        with open(filename, "r") as filedesc:
+            for line in filedesc:
+                # A torn (last) line has no newline
+                if not line.endswith("\n"):
+                    break
+                fields = utils.deconcat(line.rstrip("\n"), config.separator,
+                                        False)
+                if fields[0] == "A" and len(fields) == 10:
+                    journal['live'][int(fields[1])] = (
+                        config.separator.join(fields[2:]))
+                elif fields[0] == "D" and len(fields) == 2:
+                    for journalid in fields[1].split(","):
+                        journal['live'].pop(int(journalid), None)
+        if age > config.journal_max_age:
+            log(utils.WARNING, "B", "Journal is too old (" + str(int(age)) +
+                "s). Full sync required")
+        elif len(journal['live']) > config.journal_max_replay:
+            log(utils.WARNING, "B", "Journal has too many unfinished " +
+                "actions (" + str(len(journal['live'])) +
+                "). Full sync required")
         else:
-            backfired = False
-        if backfired:
-            if method == "RSYNC" and config.rsync_style > 1:
-                log(utils.DEBUG1, source, "Ignoring backfired event "+method+
-                    config.separator + srcfile)
+            trusted = True
+    except (IOError, OSError, ValueError, IndexError):
+        log(utils.INFO, "B", "No valid journal found")
+    if trusted:
+        for journalid in sorted(journal['live'].keys()):
+            journal['replay'].append(journalid)
+        journal['id'] = max([0] + journal['live'].keys())
+        log(utils.INFO, "B", "Journal loaded: " +
+            str(len(journal['replay'])) + " unfinished actions to replay")
+    else:
+        journal['live'] = {}
+    # Start from a compacted journal
+    journal_sync(compact=True)
+    return trusted
+
+
+def journal_replay():
+    with locks['journal']:
+        replay = journal['replay']
+        journal['replay'] = []
+        records = [(journalid, journal['live'].get(journalid))
+                   for journalid in replay]
+    for (journalid, record) in records:
+        if not record:
             continue
-        # If batched rsync is true, continue to the next event
-        if config.rsync_style == 3:
+        fields = utils.deconcat(record, config.separator, False)
+        entry = {'source': fields[0], 'method': fields[1],
+                 'itemtype': fields[2], 'flags': fields[3],
+                 'backfired': fields[4] == "True", 'eventid': fields[5],
+                 'filelist': fields[6], 'dstfile': fields[7],
+                 'recurse': False, 'updateonly': False,
+                 'journal': [journalid]}
+        log(utils.INFO, entry['source'], "Replaying journaled event " +
+            entry['method'] + config.separator + entry['filelist'],
+            eventid=entry['eventid'])
+        enqueue(entry)
+
+
+def journal_sync(compact=False):
+    filename = config.journal_dir + "journal"
+    with locks['journal']:
+        buf = journal['buffer']
+        journal['buffer'] = []
+        # Compact when most written records are stale
+        if (journal['lines'] > config.journal_compact_lines and
+                journal['lines'] > 2 * len(journal['live'])):
+            compact = True
+        if compact:
+            buf = (["A" + config.separator + str(journalid) +
+                    config.separator + journal['live'][journalid]
+                    for journalid in sorted(journal['live'].keys())] + buf)
+    if not buf and not compact:
+        return
+    if compact:
+        if journal['fd']:
+            journal['fd'].close()
+        filedesc = open(filename + ".tmp", "w")
+        journal['lines'] = 0
+    else:
+        filedesc = journal['fd']
+    filedesc.write("".join([line + "\n" for line in buf]))
+    filedesc.flush()
+    os.fsync(filedesc.fileno())
+    journal['lines'] = journal['lines'] + len(buf)
+    if compact:
+        filedesc.close()
+        os.rename(filename + ".tmp", filename)
+        # Make the rename itself durable
+        dirdesc = os.open(config.journal_dir, os.O_RDONLY)
+        try:
+            os.fsync(dirdesc)
+        finally:
+            os.close(dirdesc)
+        journal['fd'] = open(filename, "a")
+        log(utils.DEBUG1, "B", "Journal compacted: " +
+            str(journal['lines']) + " records")
+
+
+def journaler():
+    while True:
+        time.sleep(config.journal_sync_interval)
+        journal_sync()
+
+
+def account(command, source, process, output, elapsed, eventid=None):
+    # Count exit codes and, for rsync, transfer stats and wall time
+    if command == "rsync":
+        stats = utils.parse_rsync_stats(output)
+        stats['runs'] = 1
+        stats['seconds'] = elapsed
+    with locks['metrics']:
+        metrics['exits'][(source, command, process.returncode)] += 1
+        if command == "rsync":
+            metrics['rsync'][source].update(stats)
+    if command != "rsync" or not config.rsync_stats_file:
+        return
+    # speedup: file size over bytes on the wire, as rsync reports it
+    wire = stats['sent'] + stats['received']
+    record = [time.strftime("%Y-%m-%d %H:%M:%S"), source,
+              "eventid=" + str(eventid), "exit=" + str(process.returncode),
+              "seconds=" + "{0:.3f}".format(elapsed),
+              "speedup=" + "{0:.2f}".format(float(stats['size']) / wire
+                                            if wire else 0),
+              "kbps=" + "{0:.1f}".format(wire / 1024.0 / max(elapsed, 0.001))]
+    for name in ["files", "new", "updated", "attrs", "deleted", "size",
+                 "bytes", "literal", "matched", "sent", "received"]:
+        record.append(name + "=" + str(stats[name]))
+    rsyncstats['buffer'].append(" ".join(record) + "\n")
+
+
+def write_rsync_stats():
+    # Append the buffered records, rolling the file over when too big
+    filename = config.rsync_stats_file
+    lines = []
+    while rsyncstats['buffer']:
+        lines.append(rsyncstats['buffer'].popleft())
+    if not lines:
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0755)
+        if (os.path.exists(filename) and
+                os.path.getsize(filename) > config.rsync_stats_max_size):
+            os.rename(filename, filename + ".1")
+        with open(filename, "a") as filedesc:
+            filedesc.write("".join(lines))
+    except (IOError, OSError) as error:
+        log(utils.WARNING, "B", "Can not write rsync stats: " + str(error))
+
+
+def rsync_stats_writer():
+    while True:
+        time.sleep(config.rsync_stats_interval)
+        write_rsync_stats()
+
+
+def parse_fields(fields):
+    # ["name=value", ...] -> {name: value}, skipping non numeric values
+    values = {}
+    for field in fields:
+        (name, value) = (field.split("=", 1) + [""])[:2]
+        try:
+            values[name] = float(value)
+        except ValueError:
             continue
-        # Normalize dir
-        if itemtype == "DIR":
-            srcfile = utils.normalize_dir(srcfile)
-            if method == "MOVE":
-                dstfile = utils.normalize_dir(dstfile)
-        # Build filelist
+    return values
+
+
+def filter_report(source, fields):
+    # ["name=value", ...] as periodically sent by the filter
+    report = parse_fields(fields)
+    report['time'] = time.time()
+    metrics['filters'][source] = report
+
+
+def observe(stage, method, values):
+    with locks['metrics']:
+        histogram = metrics['latency'].get((stage, method))
+        if not histogram:
+            histogram = {'buckets': [0] * (len(config.metrics_buckets) + 1),
+                         'sum': 0.0, 'count': 0}
+            metrics['latency'][(stage, method)] = histogram
+        for value in values:
+            index = bisect.bisect_left(config.metrics_buckets, value)
+            histogram['buckets'][index] = histogram['buckets'][index] + 1
+            histogram['sum'] = histogram['sum'] + value
+        histogram['count'] = histogram['count'] + len(values)
+
+
+def trace_filter(entry, times, arrival):
+    # Filter stages: read (raw queue and parsing), settle (delay interval
+    # and late checks) and transit to psync. Remote transit times include
+    # the clock skew between the hosts
+    if not ('r' in times and 'p' in times and 'e' in times):
+        return
+    read = times['p'] - times['r']
+    settle = times['e'] - times['p']
+    transit = max(arrival - times['e'], 0)
+    observe("read", entry['method'], [read])
+    observe("settle", entry['method'], [settle])
+    observe("transit", entry['method'], [transit])
+    log(utils.DEBUG2, entry['source'],
+        "Latency: read %.3fs, settle %.3fs, transit %.3fs",
+        eventid=entry['eventid'], args=(read, settle, transit))
+
+
+def trace_action(action, method, started):
+    # psync stages of every event carried by the action: queue (until a
+    # worker picked the action) and execute
+    now = time.time()
+    arrivals = action.get('arrivals', [])
+    if not arrivals:
+        return
+    observe("queue", method, [started - arrival for arrival in arrivals])
+    observe("execute", method, [now - started] * len(arrivals))
+    log(utils.DEBUG1, action['source'],
+        "Latency: queue %.3fs, execute %.3fs (%d events)",
+        eventid=action['eventid'],
+        args=(started - arrivals[0], now - started, len(arrivals)))
+
+
+def render_metrics():
+    # Prometheus text exposition format
+    now = time.time()
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append("# HELP psync_" + name + " " + description)
+        lines.append("# TYPE psync_" + name + " " + kind)
+        for (labels, value) in samples:
+            labels = ",".join(key + '="' + str(labels[key]) + '"'
+                              for key in sorted(labels))
+            if labels:
+                labels = "{" + labels + "}"
+            lines.append("psync_" + name + labels + " " + str(value))
+
+    sides = ["L", "R"]
+    with locks['metrics']:
+        exits = dict(metrics['exits'])
+        kills = dict(metrics['kills'])
+        rsyncs = dict((side, dict(metrics['rsync'][side])) for side in sides)
+        latency = dict((key, dict(value, buckets=list(value['buckets'])))
+                       for (key, value) in metrics['latency'].iteritems())
+    reports = dict((side, metrics['filters'][side]) for side in sides)
+    metric("filter_queue_length", "gauge",
+           "Events queued by the filter, as of its last report",
+           [({'side': side, 'queue': queue}, reports[side][queue])
+            for side in sides for queue in ["raw_queue", "actions"]
+            if queue in reports[side]])
+    metric("filter_degraded", "gauge",
+           "Whether the filter queue is over its high watermark",
+           [({'side': side}, reports[side]['degraded'])
+            for side in sides if 'degraded' in reports[side]])
+    metric("filter_settled_events_total", "counter",
+           "Repeated events folded by the filter into a queued one",
+           [({'side': side}, reports[side]['settled'])
+            for side in sides if 'settled' in reports[side]])
+    metric("filter_storms_total", "counter",
+           "Dirs whose event storm the filter collapsed into a recursive "
+           "RSYNC",
+           [({'side': side}, reports[side]['storms'])
+            for side in sides if 'storms' in reports[side]])
+    metric("filter_covered_events_total", "counter",
+           "Queued events dropped by the filter, their dir being collapsed "
+           "later",
+           [({'side': side}, reports[side]['covered'])
+            for side in sides if 'covered' in reports[side]])
+    metric("filter_syscalls_total", "counter",
+           "Stat and listdir calls of the filter checks: done, or saved by "
+           "its metadata cache",
+           [({'side': side, 'call': call, 'result': result},
+             reports[side][call + "_" + result])
+            for side in sides for call in ["stat", "listdir"]
+            for result in ["calls", "saved"]
+            if call + "_" + result in reports[side]])
+    metric("filter_report_age_seconds", "gauge",
+           "Seconds since the last filter report",
+           [({'side': side}, now - reports[side]['time'])
+            for side in sides if reports[side]])
+    metric("actions_queue_length", "gauge", "Actions waiting for dispatch",
+           [({}, len(actions))])
+    metric("queued_paths", "gauge", "Paths touched by queued actions",
+           [({}, len(queued['paths']))])
+    metric("queue_degraded", "gauge",
+           "Whether the actions queue is over its high watermark",
+           [({}, int(state['queue_degraded']))])
+    metric("actions_running", "gauge", "Actions being executed",
+           [({'lane': lane}, executor['running'][lane])
+            for lane in sorted(config.executor_lanes)])
+    limits = bandwidth_limits(int(time.strftime("%H")))
+    with conditions['bandwidth']:
+        leases = bandwidth['leases'].values()
+    metric("bandwidth_limit_kbytes", "gauge",
+           "Current bandwidth cap, in KB/s (0: none)",
+           [({'class': name}, limits[name]) for name in sorted(limits)])
+    metric("bandwidth_leased_kbytes", "gauge",
+           "Bandwidth leased to running rsyncs, in KB/s (0: unlimited)",
+           [({'class': name},
+             sum([kbps for (other, kbps) in leases if other == name]))
+            for name in sorted(limits) if name != "all"])
+    metric("commands_in_flight", "gauge", "Commands being executed",
+           [({}, len(heartbeats['execute']) - 1)])
+    metric("pendings", "gauge", "Events tracked for backfire detection",
+           [({'side': side}, len(pendings[side])) for side in sides])
+    metric("current_merges", "gauge",
+           "Events merged into the latest queued action",
+           [({}, state['current_merges'])])
+    metric("journal_live", "gauge", "Accepted events not completed yet",
+           [({}, len(journal['live']))])
+    for name in ["pendings_hits", "pendings_misses", "pendings_expired",
+                 "ssh_handshakes", "ssh_handshakes_avoided",
+                 "ssh_reconnects", "coalesced_duplicates",
+                 "coalesced_cancels", "coalesced_moves",
+                 "queue_degradations", "queue_collapsed", "queue_dropped",
+                 "retries", "retry_escalations", "retry_giveups"]:
+        metric(name + "_total", "counter", name.replace("_", " ").capitalize(),
+               [({}, state[name])])
+    metric("command_exits_total", "counter", "Executed commands by exit code",
+           [({'side': key[0], 'command': key[1], 'code': key[2]}, exits[key])
+            for key in sorted(exits)])
+    metric("command_kills_total", "counter",
+           "Commands terminated, then killed, at their timeout",
+           [({'command': key[0], 'signal': key[1]}, kills[key])
+            for key in sorted(kills)])
+    metric("rsync_files_total", "counter", "Files transferred by rsync",
+           [({'side': side}, rsyncs[side].get('files', 0)) for side in sides])
+    metric("rsync_bytes_total", "counter", "File bytes transferred by rsync",
+           [({'side': side}, rsyncs[side].get('bytes', 0)) for side in sides])
+    metric("rsync_sent_bytes_total", "counter", "Bytes sent by rsync",
+           [({'side': side}, rsyncs[side].get('sent', 0)) for side in sides])
+    metric("rsync_received_bytes_total", "counter", "Bytes received by rsync",
+           [({'side': side}, rsyncs[side].get('received', 0))
+            for side in sides])
+    metric("rsync_size_bytes_total", "counter",
+           "Size of the files checked by rsync. Over sent and received "
+           "bytes, it is the rsync speedup",
+           [({'side': side}, rsyncs[side].get('size', 0)) for side in sides])
+    metric("rsync_data_bytes_total", "counter",
+           "Literal (sent) and matched (delta reused) file data",
+           [({'side': side, 'kind': kind}, rsyncs[side].get(kind, 0))
+            for side in sides for kind in ["literal", "matched"]])
+    metric("rsync_changes_total", "counter", "Itemized rsync changes",
+           [({'side': side, 'change': change}, rsyncs[side].get(change, 0))
+            for side in sides
+            for change in ["new", "updated", "attrs", "deleted"]])
+    metric("rsync_runs_total", "counter", "Executed rsyncs",
+           [({'side': side}, rsyncs[side].get('runs', 0)) for side in sides])
+    metric("rsync_seconds_total", "counter", "Wall time spent in rsync",
+           [({'side': side}, rsyncs[side].get('seconds', 0))
+            for side in sides])
+    metric("heartbeat_age_seconds", "gauge", "Seconds since the last beat",
+           [({'name': name}, now - heartbeats[name]['last'])
+            for name in sides + ["dequeue"]])
+    metric("fullsync_last_timestamp_seconds", "gauge",
+           "End of the last successful whole-tree full sync",
+           [({}, state['fullsync_last'])])
+    metric("event_latency_seconds", "histogram",
+           "Time spent by events in each stage", [])
+    bounds = [str(bound) for bound in config.metrics_buckets] + ["+Inf"]
+    for (stage, method) in sorted(latency):
+        histogram = latency[(stage, method)]
+        labels = 'method="' + method + '",stage="' + stage + '"'
+        count = 0
+        for i in range(len(bounds)):
+            count = count + histogram['buckets'][i]
+            lines.append("psync_event_latency_seconds_bucket{" + labels +
+                         ',le="' + bounds[i] + '"} ' + str(count))
+        lines.append("psync_event_latency_seconds_sum{" + labels + "} " +
+                     str(histogram['sum']))
+        lines.append("psync_event_latency_seconds_count{" + labels + "} " +
+                     str(histogram['count']))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_server():
+    # Minimal HTTP server: whatever the request, answer with the metrics
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((config.metrics_address, config.metrics_port))
+    except socket.error as error:
+        log(utils.ERROR, "B", "Can not serve metrics on " +
+            config.metrics_address + ":" + str(config.metrics_port) + ": " +
+            str(error))
+        return
+    server.listen(5)
+    while True:
+        (client, address) = server.accept()
         try:
-            prev = actions.pop()
-            # Is mergeable?
-            if (
-                    # is not a symlink
-                    not os.path.islink(srcfile) and
-                    # source and method are same than previous
-                    source == prev['source'] and method == prev['method'] and (
-                        (
-                            # method is rsync and other options are the same
-                            prev['method'] == "RSYNC" and
-                            prev['backfired'] == backfired and
-                            prev['flags'] == flags
-                        ) or (
-                            # method is delete
-                            prev['method'] == "DELETE"
-                        )
-                    )
-                ):
-                filelist = utils.concat(prev['filelist'], srcfile)
-                state['current_merges'] = state['current_merges'] + 1
+            client.settimeout(5)
+            client.recv(4096)
+            body = render_metrics()
+            client.sendall("HTTP/1.0 200 OK\r\n" +
+                           "Content-Type: text/plain; version=0.0.4\r\n" +
+                           "Content-Length: " + str(len(body)) + "\r\n" +
+                           "\r\n" + body)
+        except Exception as error:
+            log(utils.WARNING, "B", "Metrics request failed: " + str(error))
+        finally:
+            client.close()
+
+
+def next_flush():
+    # Seconds until the oldest rsync batch expires or the next retry is
+    # due, None if neither
+    dues = []
+    if config.rsync_style == 3:
+        with locks['batches']:
+            dues = [batch['first'] + config.rsync_batch_window
+                    for source in batches
+                    for batch in batches[source].values()]
+    with locks['retries']:
+        if retries['heap']:
+            dues.append(retries['heap'][0][0])
+    if not dues:
+        return None
+    return max(0.01, min(dues) - time.time())
+
+
+def schedule_deadline(entry):
+    # Terminate the command when its timeout expires
+    if not entry['timeout']:
+        return
+    with conditions['deadlines']:
+        heapq.heappush(deadlines['heap'],
+                       (entry['last'] + entry['timeout'], entry['pid'],
+                        "terminate", entry))
+        if deadlines['heap'][0][3] is entry:
+            conditions['deadlines'].notify()
+
+
+def reaper():
+    # Terminate slow commands at their deadline, then kill them if they
+    # are still alive after a grace period
+    while True:
+        with conditions['deadlines']:
+            heap = deadlines['heap']
+            while not heap or heap[0][0] > time.time():
+                if heap:
+                    conditions['deadlines'].wait(heap[0][0] - time.time())
+                else:
+                    conditions['deadlines'].wait()
+            (deadline, pid, signal, entry) = heapq.heappop(heap)
+            # Completed commands are not registered anymore
+            if heartbeats['execute'].get(pid) is not entry:
+                continue
+            if signal == "terminate":
+                heapq.heappush(heap, (deadline + config.etimeout_grace, pid,
+                                      "kill", entry))
+        try:
+            if signal == "terminate":
+                entry['process'].terminate()
             else:
-                state['current_merges'] = 0
-                filelist = srcfile
-                actions.append(prev)
-        except:
-            state['current_merges'] = 0
-            filelist = srcfile
-        log(utils.DEBUG1, source,
-            "Current merges: " + str(state['current_merges']))
-        entry = {'source': source, 'method': method, 'itemtype': itemtype,
-                 'filelist': filelist, 'dstfile': dstfile,
-                 'eventid': checksum[-5:], 'backfired': backfired,
-                 'flags': flags, 'recurse': False, 'updateonly': False}
-        actions.append(entry)
+                entry['process'].kill()
+        except OSError:
+            continue
+        with locks['metrics']:
+            metrics['kills'][(entry['command'], signal)] += 1
+        if signal == "terminate":
+            log(utils.INFO, "B", "SLOW PROCESS WITH PID " + str(pid) +
+                " TERMINATED: " + str(entry['process']) + " (" +
+                entry['command'] + ", " +
+                "{0:.3f}".format(time.time() - deadline) + "s late)")
+        else:
+            log(utils.WARNING, "B", "SLOW PROCESS WITH PID " + str(pid) +
+                " KILLED: " + str(entry['process']) + " (" +
+                entry['command'] + ")")
 
 
 def search_banned():
@@ -734,13 +2361,40 @@ def print_config():
             continue
         log(utils.DEBUG2, "B", key+": "+str(value))
 
+
+def check_integrity():
+    # Without a key, a keyed digest guards against corruption only
+    if config.integrity_key:
+        return
+    if config.integrity_hash.startswith("hmac-"):
+        log(utils.FATAL, "B", "FATAL: integrity_hash " +
+            config.integrity_hash + " needs an integrity_key, shared by " +
+            "both partners. Set one, or choose an unkeyed digest")
+        quit(1)
+    if config.integrity_hash == "blake2b":
+        log(utils.WARNING, "B", "integrity_key is empty: blake2b digests " +
+            "do not protect against tampering")
+
 # Parse options and print config
 (options, args) = parse_options()
 print_config()
+check_integrity()
+# Enforce command timeouts
+command_reaper = threading.Thread(name="reaper", target=reaper)
+command_reaper.daemon = True
+command_reaper.start()
+# Open SSH control connections
+atexit.register(ssh_disconnect)
+ssh_supervise()
 # Synchronize peers
 search_banned()
 if options.skipsync:
-    pass
+    journal_load()
+elif journal_load():
+    log(utils.INFO, "B", "Valid journal found. Skipping initial sync, " +
+        "catching up in background")
+    register_dir("L", options.srcroot)
+    state['fullsync_catchup'] = True
 else:
     if not full_syncher(True):
         log(utils.FATAL, "B",
@@ -757,6 +2411,22 @@ if options.synconly:
 # Establish connections and start reading
 (left, lreader) = connect_left()
 (right, rreader) = connect_right()
+# Write journal
+if config.journal_dir:
+    journal_writer = threading.Thread(name="journaler", target=journaler)
+    journal_writer.daemon = True
+    journal_writer.start()
+# Write rsync stats
+if config.rsync_stats_file:
+    stats_writer = threading.Thread(name="rsyncstats",
+                                    target=rsync_stats_writer)
+    stats_writer.daemon = True
+    stats_writer.start()
+# Serve metrics
+if config.metrics_port:
+    metrics_thread = threading.Thread(name="metrics", target=metrics_server)
+    metrics_thread.daemon = True
+    metrics_thread.start()
 # Propagate changes
 replicator = threading.Thread(name="replicator", target=dequeue)
 replicator.daemon = True
@@ -769,38 +2439,8 @@ full_syncher.start()
 while True:
     # Verify that no harmful process are running
     search_banned()
-    # Check for (and kill) slow processes
-    for pid in heartbeats['execute'].keys():
-        # If pid is not numeric, something is wrong. Continue with next process
-        if type(pid) is not int:
-            continue
-        # If process does not exists anymore in the list, continue
-        try:
-            process = heartbeats['execute'][pid]['process']
-        except:
-            continue
-        # If process was terminated/killed, remove it from list and continue
-        if process.poll():
-            heartbeats['execute'].pop(pid, None)
-            continue
-        # If the process does not terminate, kill it
-        if timedout(['execute', pid], grace=10):
-            try:
-                process.kill()
-            except:
-                pass
-            log(utils.WARNING, "B",
-                "SLOW PROCESS WITH PID " + str(pid) +
-                " KILLED: " + str(process))
-        # Try to gracefully terminate the process
-        elif timedout(['execute', pid]):
-            try:
-                process.terminate()
-            except:
-                pass
-            log(utils.INFO, "B",
-                "SLOW PROCESS WITH PID " + str(pid) +
-                " TERMINATED: " + str(process))
+    # Check SSH control connections
+    ssh_supervise()
     # If connections establishment is impossible, quit
     if timedout("L", heart_field='truelast', timeout_field="maxtimeout"):
         log(utils.FATAL, "L",
@@ -822,6 +2462,12 @@ while True:
         log(utils.ERROR, "R",
             "Lost connection to remote host\n" + "Reconnecting...")
         (right, rreader) = connect_right()
+    # Once both sides are ready, queue unfinished actions of the previous
+    # run, even if no event comes
+    if journal['replay'] and are_ready():
+        journal_replay()
+    # Let the dispatcher beat, even when idle
+    wakeup()
     # Check consumer thread
     if timedout("dequeue"):
         log(utils.FATAL, "B", "Blocked or crashed dequeue thread. Exiting")
@@ -831,4 +2477,24 @@ while True:
             "Running dequeue thread. Last seen on " +
             time.strftime("%Y-%m-%d %H:%M:%S",
                           time.localtime(heartbeats['dequeue']['last'])))
+    log(utils.DEBUG2, "B",
+        "Pendings: " + str(len(pendings['L'])) + " L, " +
+        str(len(pendings['R'])) + " R, " +
+        str(state['pendings_hits']) + " hits, " +
+        str(state['pendings_misses']) + " misses, " +
+        str(state['pendings_expired']) + " expired")
+    log(utils.DEBUG2, "B",
+        "SSH: " + str(state['ssh_handshakes']) + " handshakes, " +
+        str(state['ssh_handshakes_avoided']) + " avoided, " +
+        str(state['ssh_reconnects']) + " reconnects")
+    log(utils.DEBUG2, "B",
+        "Coalescing: " + str(state['coalesced_duplicates']) + " duplicates, " +
+        str(state['coalesced_cancels']) + " cancels, " +
+        str(state['coalesced_moves']) + " folded moves")
+    log(utils.DEBUG2, "B",
+        "Queue: " + str(len(queued['paths'])) + " paths, " +
+        ("degraded" if state['queue_degraded'] else "normal") + ", " +
+        str(state['queue_degradations']) + " degradations, " +
+        str(state['queue_collapsed']) + " collapsed, " +
+        str(state['queue_dropped']) + " dropped")
     time.sleep(5)
@@ -0,0 +1,25 @@
+# Shared by the tests: run them from the repository root with
+# python2 -m unittest discover -s tests
+import optparse
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.dont_write_bytecode = True
+
+
+def load_psync(**values):
+    # psync.py starts replicating as soon as it runs: take its definitions
+    # only, up to the startup code, with values as command line options
+    filename = os.path.join(root, "psync.py")
+    with open(filename, "r") as filedesc:
+        source = filedesc.read()
+    source = source[:source.index("\n# Parse options and print config")]
+    namespace = {'__name__': "psync", '__file__': filename}
+    exec(compile(source, filename, "exec"), namespace)
+    options = {'debug': 0, 'srcroot': "/srv/left/", 'dstroot': "/srv/right/",
+               'dsthost': "right", 'force': 0, 'rsync_extra': []}
+    options.update(values)
+    namespace['options'] = optparse.Values(options)
+    return namespace
@@ -0,0 +1,90 @@
+import unittest
+
+import common
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.psync = common.load_psync()
+        self.eventid = 0
+
+    def enqueue(self, method, filelist, dstfile="", source="L"):
+        self.eventid = self.eventid + 1
+        root = self.psync['options'].srcroot
+        if source == "R":
+            root = self.psync['options'].dstroot
+        entry = {'source': source, 'method': method, 'itemtype': "FILE",
+                 'filelist': root + filelist,
+                 'dstfile': dstfile and root + dstfile,
+                 'eventid': str(self.eventid), 'backfired': False,
+                 'flags': "normal", 'recurse': False, 'updateonly': False,
+                 'size': 0, 'arrivals': [], 'journal': [self.eventid]}
+        self.psync['enqueue'](entry)
+
+    def queued(self):
+        relpath = self.psync['relpath']
+        return [(action['method'], relpath(action['source'],
+                                           action['filelist']),
+                 action['dstfile'] and relpath(action['source'],
+                                               action['dstfile']))
+                for action in self.psync['actions']
+                if not action.get('cancelled')]
+
+    def test_duplicate_rsync(self):
+        self.enqueue("RSYNC", "a")
+        self.enqueue("RSYNC", "a")
+        self.assertEqual(self.queued(), [("RSYNC", "/a", "")])
+        self.assertEqual(self.psync['actions'][0]['journal'], [1, 2])
+
+    def test_delete_cancels_rsync(self):
+        self.enqueue("RSYNC", "a")
+        self.enqueue("DELETE", "a")
+        self.assertEqual(self.queued(), [("DELETE", "/a", "")])
+
+    def test_rsync_cancels_delete(self):
+        self.enqueue("DELETE", "a")
+        self.enqueue("RSYNC", "a")
+        self.assertEqual(self.queued(), [("RSYNC", "/a", "")])
+
+    def test_sides_apart(self):
+        self.enqueue("RSYNC", "a")
+        self.enqueue("DELETE", "a", source="R")
+        self.assertEqual(self.queued(), [("RSYNC", "/a", ""),
+                                         ("DELETE", "/a", "")])
+
+    def test_chained_moves(self):
+        # Had b existed, a->b replaced it: it must not survive the fold
+        self.enqueue("MOVE", "a", "b")
+        self.enqueue("MOVE", "b", "c")
+        self.assertEqual(self.queued(), [("MOVE", "/a", "/c"),
+                                         ("DELETE", "/b", "")])
+        (move, delete) = self.psync['actions']
+        self.assertEqual(move['journal'], [1, 2])
+        self.assertEqual(delete['journal'], [])
+
+    def test_move_back(self):
+        self.enqueue("MOVE", "a", "b")
+        self.enqueue("MOVE", "b", "a")
+        self.assertEqual(self.queued(), [("DELETE", "/b", "")])
+
+    def test_moves_not_folded_over_later_actions(self):
+        self.enqueue("MOVE", "a", "b")
+        self.enqueue("RSYNC", "c")
+        self.enqueue("MOVE", "b", "c")
+        self.assertEqual(self.queued(), [("MOVE", "/a", "/b"),
+                                         ("RSYNC", "/c", ""),
+                                         ("MOVE", "/b", "/c")])
+
+    def test_overtaken_rsync(self):
+        # A DELETE of the parent dir came in between: order matters
+        self.enqueue("RSYNC", "dir/a")
+        self.enqueue("DELETE", "dir")
+        self.enqueue("RSYNC", "dir/a")
+        self.assertEqual(self.queued(), [("RSYNC", "/dir/a", ""),
+                                         ("DELETE", "/dir", ""),
+                                         ("RSYNC", "/dir/a", "")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import StringIO
+import unittest
+
+import common
+from libs import config
+from libs import utils
+
+
+class FrameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (config.integrity_hash, config.integrity_key)
+        config.integrity_hash = "hmac-sha1"
+        config.integrity_key = "secret"
+
+    def tearDown(self):
+        (config.integrity_hash, config.integrity_key) = self.saved
+
+    def test_round_trip(self):
+        records = [["RSYNC", "FILE", "/srv/left/a b", "", "normal"],
+                   ["DELETE", "DIR", "/srv/left/dir/", "", "normal"],
+                   [""]]
+        stream = StringIO.StringIO(utils.pack_frame(3, records) +
+                                   utils.pack_frame(1, []))
+        self.assertEqual(utils.read_frame(stream), (3, records))
+        self.assertEqual(utils.read_frame(stream), (1, []))
+        self.assertEqual(utils.read_frame(stream), None)
+
+    def test_every_digest(self):
+        for algorithm in ["md5", "sha1", "crc32", "hmac-md5", "hmac-sha256"]:
+            config.integrity_hash = algorithm
+            frame = utils.pack_frame(2, [["HEARTBEAT", "L"]])
+            self.assertEqual(utils.read_frame(StringIO.StringIO(frame)),
+                             (2, [["HEARTBEAT", "L"]]))
+
+    def test_corruption(self):
+        frame = utils.pack_frame(3, [["RSYNC", "FILE", "/srv/left/a"]])
+        offset = utils.frame_header.size + 4
+        corrupted = frame[:offset] + "X" + frame[offset + 1:]
+        self.assertRaises(ValueError, utils.read_frame,
+                          StringIO.StringIO(corrupted))
+
+    def test_wrong_key(self):
+        frame = utils.pack_frame(3, [["RSYNC", "FILE", "/srv/left/a"]])
+        config.integrity_key = "other"
+        self.assertRaises(ValueError, utils.read_frame,
+                          StringIO.StringIO(frame))
+
+    def test_truncated(self):
+        frame = utils.pack_frame(3, [["RSYNC", "FILE", "/srv/left/a"]])
+        for length in [1, utils.frame_header.size, len(frame) - 1]:
+            self.assertRaises(ValueError, utils.read_frame,
+                              StringIO.StringIO(frame[:length]))
+
+    def test_bad_header(self):
+        frame = utils.pack_frame(3, [])
+        self.assertRaises(ValueError, utils.read_frame,
+                          StringIO.StringIO("XXX" + frame[3:]))
+        self.assertRaises(ValueError, utils.read_frame,
+                          StringIO.StringIO(frame[:3] + chr(1) + frame[4:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import tempfile
+import shutil
+import time
+import os
+import unittest
+
+import common
+from libs import config
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (config.journal_dir, config.journal_compact_lines,
+                      config.journal_max_replay, config.journal_max_age)
+        config.journal_dir = tempfile.mkdtemp() + "/"
+        self.filename = config.journal_dir + "journal"
+        self.runs = []
+
+    def tearDown(self):
+        for psync in self.runs:
+            if psync['journal']['fd']:
+                psync['journal']['fd'].close()
+        shutil.rmtree(config.journal_dir)
+        (config.journal_dir, config.journal_compact_lines,
+         config.journal_max_replay, config.journal_max_age) = self.saved
+
+    def start(self):
+        # A new psync run on the same journal
+        psync = common.load_psync()
+        self.runs.append(psync)
+        return (psync, psync['journal_load']())
+
+    def accept(self, psync, filelist):
+        entry = {'source': "L", 'method': "RSYNC", 'itemtype': "FILE",
+                 'flags': "normal", 'backfired': False, 'eventid': filelist,
+                 'filelist': "/srv/left/" + filelist, 'dstfile': ""}
+        psync['journal_accept'](entry)
+        return entry['journal']
+
+    def records(self):
+        with open(self.filename, "r") as filedesc:
+            return [line.split(config.separator)[0] for line in filedesc]
+
+    def test_round_trip(self):
+        (psync, trusted) = self.start()
+        self.assertFalse(trusted)
+        ids = [self.accept(psync, name) for name in ["a", "b", "c"]]
+        psync['journal_done'](ids[1])
+        psync['journal_sync']()
+        # Crash before the last write: a torn line is ignored
+        psync['journal']['fd'].write("A" + config.separator + "9")
+        psync['journal']['fd'].flush()
+        (psync, trusted) = self.start()
+        self.assertTrue(trusted)
+        self.assertEqual(psync['journal']['replay'], ids[0] + ids[2])
+        self.assertEqual(psync['journal']['id'], ids[2][0])
+        # Loaded compacted: unfinished events only
+        self.assertEqual(self.records(), ["A", "A"])
+        self.assertFalse(os.path.exists(self.filename + ".tmp"))
+        psync['journal_replay']()
+        self.assertEqual([(action['filelist'], action['journal'])
+                          for action in psync['actions']],
+                         [("/srv/left/a\n/srv/left/c", ids[0] + ids[2])])
+
+    def test_compaction(self):
+        config.journal_compact_lines = 10
+        (psync, trusted) = self.start()
+        for i in range(20):
+            psync['journal_done'](self.accept(psync, str(i)))
+        kept = self.accept(psync, "kept")
+        psync['journal_sync']()
+        self.assertEqual(len(self.records()), 41)
+        # Mostly stale records: rewritten on the next write
+        psync['journal_sync']()
+        self.assertEqual(self.records(), ["A"])
+        psync['journal_done'](kept)
+        psync['journal_sync']()
+        (psync, trusted) = self.start()
+        self.assertTrue(trusted)
+        self.assertEqual(psync['journal']['replay'], [])
+        self.assertEqual(self.records(), [])
+
+    def test_too_old(self):
+        config.journal_max_age = 60
+        (psync, trusted) = self.start()
+        self.accept(psync, "a")
+        psync['journal_sync']()
+        past = time.time() - 120
+        os.utime(self.filename, (past, past))
+        (psync, trusted) = self.start()
+        self.assertFalse(trusted)
+        self.assertEqual(psync['journal']['replay'], [])
+        self.assertEqual(self.records(), [])
+
+    def test_too_many(self):
+        config.journal_max_replay = 1
+        (psync, trusted) = self.start()
+        self.accept(psync, "a")
+        self.accept(psync, "b")
+        psync['journal_sync']()
+        (psync, trusted) = self.start()
+        self.assertFalse(trusted)
+        self.assertEqual(self.records(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
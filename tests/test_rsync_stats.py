@@ -0,0 +1,82 @@
+import unittest
+
+import common
+from libs import utils
+
+# rsync -ai --stats, 3.1 and later
+OUTPUT = """\
+>f+++++++++ docs/new.txt
+>f.st...... docs/report.odt
+.d..t...... docs/
+.f...p..... bin/run.sh
+cd+++++++++ photos/
+<f.st...... upload.bin
+*deleting   docs/old.txt
+
+Number of files: 1,204 (reg: 1,100, dir: 104)
+Number of created files: 2 (reg: 1, dir: 1)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 3
+Total file size: 52,428,800 bytes
+Total transferred file size: 1,049,600 bytes
+Literal data: 10,240 bytes
+Matched data: 1,039,360 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 11,523
+Total bytes received: 1,234
+
+sent 11,523 bytes  received 1,234 bytes  25,514.00 bytes/sec
+total size is 52,428,800  speedup is 4,109.86
+"""
+
+# rsync 3.0 names the transferred files counter differently
+OUTPUT_30 = """\
+>f+++++++++ a
+
+Number of files: 3
+Number of files transferred: 1
+Total file size: 2048 bytes
+Total transferred file size: 2048 bytes
+Literal data: 2048 bytes
+Matched data: 0 bytes
+File list size: 40
+Total bytes sent: 2150
+Total bytes received: 31
+
+sent 2150 bytes  received 31 bytes  4362.00 bytes/sec
+total size is 2048  speedup is 0.94
+"""
+
+
+class RsyncStatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        stats = utils.parse_rsync_stats(OUTPUT)
+        self.assertEqual(stats, {'files': 3, 'size': 52428800,
+                                 'bytes': 1049600, 'literal': 10240,
+                                 'matched': 1039360, 'sent': 11523,
+                                 'received': 1234, 'new': 2, 'updated': 2,
+                                 'attrs': 2, 'deleted': 1})
+
+    def test_rsync_30(self):
+        stats = utils.parse_rsync_stats(OUTPUT_30)
+        self.assertEqual((stats['files'], stats['size'], stats['sent'],
+                          stats['received'], stats['new']),
+                         (1, 2048, 2150, 31, 1))
+
+    def test_no_output(self):
+        for output in [None, "", "rsync: connection unexpectedly closed\n"]:
+            stats = utils.parse_rsync_stats(output)
+            self.assertEqual(sum(stats.values()), 0)
+
+    def test_strip(self):
+        stripped = utils.strip_rsync_stats(OUTPUT)
+        self.assertTrue(stripped.endswith("*deleting   docs/old.txt"))
+        self.assertEqual(utils.strip_rsync_stats(OUTPUT_30.split("\n")[0]),
+                         ">f+++++++++ a")
+
+
+if __name__ == "__main__":
+    unittest.main()